@@ -0,0 +1,363 @@
+import os
+import os.path
+import re
+import sys
+import json
+import logging
+import datetime
+import argparse
+import zipfile
+import warnings
+
+
+def config_logger(name: str=__name__, level: int=logging.DEBUG):
+    logger = logging.getLogger(name)
+    if not logger.hasHandlers():
+        logger.propagate = False
+        logger.setLevel(level)
+        f_str = '%(asctime)s,%(msecs)3d %(levelname)-7s %(filename)s %(funcName)s(%(lineno)s) %(message)s'
+        log_formatter = logging.Formatter(f_str, datefmt='%H:%M:%S')
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(log_formatter)
+        logger.addHandler(console_handler)
+    return logger
+
+
+# Configure logging
+LOGGER = config_logger()
+
+PROG_NAME = "Shot Archive Compactor"
+PROG_NAME_SHORT = "ArchiveCompactor"
+PROG_VERSION = "1.0"
+
+LOCK_FILE_NAME = "lock.lock"
+INDEX_ENTRY = "index.json"
+CONTAINER_SUFFIX = ".shots.zip"
+CODECS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+SHOT_ZIP_RE = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{6}\.zip$')
+DAY_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+LOG_SHOT_RE = re.compile(r'; Shot=(\d+).*; File=([^;\s]+)')
+# Further shots of one shot zip (same second) are packed as '<key>#2', '<key>#3' ...
+KEY_SEPARATOR = '#'
+# Late analysis results appended by ShotDumper, 'analysis/results_<shot>.txt'
+ANALYSIS_RE = re.compile(r'^analysis/results(?:_(\d+))?\.txt$')
+
+
+def print_exception_info(level=logging.DEBUG):
+    LOGGER.log(level, "Exception ", exc_info=True)
+
+
+def day_folders(root):
+    # Walk outDir/YYYY/YYYY-MM/YYYY-MM-DD layout written by ShotDumper
+    result = []
+    for y in sorted(os.listdir(root)):
+        yp = os.path.join(root, y)
+        if not (os.path.isdir(yp) and y.isdigit()):
+            continue
+        for m in sorted(os.listdir(yp)):
+            mp = os.path.join(yp, m)
+            if not (os.path.isdir(mp) and m.startswith(y)):
+                continue
+            for d in sorted(os.listdir(mp)):
+                dp = os.path.join(mp, d)
+                if os.path.isdir(dp) and DAY_RE.match(d) and d.startswith(m):
+                    result.append(dp)
+    return result
+
+
+def folder_date(folder):
+    try:
+        return datetime.datetime.strptime(os.path.basename(os.path.normpath(folder)), '%Y-%m-%d').date()
+    except:
+        return None
+
+
+def is_locked(folder):
+    return os.path.exists(os.path.join(folder, LOCK_FILE_NAME))
+
+
+def lock_folder(folder):
+    # Same convention as ShotDumper.lock_dir: presence of lock.lock means folder is busy.
+    # Exclusive create ('x' is O_CREAT | O_EXCL), so two tools can not both take the folder.
+    fn = os.path.join(folder, LOCK_FILE_NAME)
+    try:
+        lock_file = open(fn, 'x')
+    except FileExistsError:
+        return None
+    lock_file.write(PROG_NAME_SHORT)
+    lock_file.flush()
+    return lock_file
+
+
+def unlock_folder(lock_file):
+    if lock_file is not None:
+        lock_file.close()
+        try:
+            os.remove(lock_file.name)
+        except:
+            print_exception_info()
+
+
+def shot_zip_files(folder):
+    return sorted(f for f in os.listdir(folder) if SHOT_ZIP_RE.match(f))
+
+
+def container_name(folder):
+    return os.path.join(folder, os.path.basename(os.path.normpath(folder)) + CONTAINER_SUFFIX)
+
+
+def read_shot_numbers(folder):
+    # Map shot zip file name -> last shot number written into it
+    return {fn: numbers[-1] for fn, numbers in read_shot_lists(folder).items()}
+
+
+def read_shot_lists(folder):
+    # Map shot zip file name -> shot numbers in log order using the daily log
+    shots = {}
+    log_file_name = os.path.join(folder, os.path.basename(os.path.normpath(folder)) + '.log')
+    if not os.path.exists(log_file_name):
+        return shots
+    try:
+        with open(log_file_name, 'r', errors='replace') as log_file:
+            for line in log_file:
+                m = LOG_SHOT_RE.search(line)
+                if m:
+                    shots.setdefault(m.group(2), []).append(int(m.group(1)))
+    except:
+        LOGGER.log(logging.WARNING, "Error reading log file %s" % log_file_name)
+        print_exception_info()
+    return shots
+
+
+def base_key(key):
+    return key.partition(KEY_SEPARATOR)[0]
+
+
+def shot_key(key, n):
+    # Key of n-th (from 0) shot written into one shot zip
+    if n <= 0:
+        return key
+    return '%s%s%d' % (key, KEY_SEPARATOR, n + 1)
+
+
+def split_members(infos, numbers=None):
+    # Shot zip members grouped by shot: ShotDumper appends a shot in the same
+    # second to the existing zip, so a repeated name starts the next shot.
+    # Analysis results are appended later in any order, they go to the group
+    # of their shot number (numbers from the daily log), else to the first one.
+    groups = [[]]
+    names = set()
+    results = []
+    for info in infos:
+        m = ANALYSIS_RE.match(info.filename)
+        if m is not None:
+            results.append((m.group(1), info))
+            continue
+        if info.filename in names:
+            groups.append([])
+            names = set()
+        groups[-1].append(info)
+        names.add(info.filename)
+    for shot, info in results:
+        n = 0
+        if shot is not None and numbers is not None and len(numbers) == len(groups) and int(shot) in numbers:
+            n = numbers.index(int(shot))
+        groups[n].append(info)
+    return groups
+
+
+def read_index(zip_file):
+    try:
+        return json.loads(zip_file.read(INDEX_ENTRY).decode())
+    except KeyError:
+        return {'version': 1, 'shots': {}}
+
+
+class ShotContainer:
+    # Read only access to a compacted day container.
+    # Member lookup goes through the zip central directory (a dict), so reading
+    # one channel costs a single seek regardless of the container size.
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.zip_file = zipfile.ZipFile(file_name, 'r')
+        self.index = read_index(self.zip_file)
+        self.by_number = {}
+        for key, value in self.index['shots'].items():
+            if value.get('shot') is not None:
+                self.by_number[value['shot']] = key
+
+    def close(self):
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def shots(self):
+        return list(self.index['shots'])
+
+    def resolve(self, shot):
+        if isinstance(shot, int):
+            return self.by_number[shot]
+        return shot.replace('.zip', '')
+
+    def members(self, shot):
+        return list(self.index['shots'][self.resolve(shot)]['members'])
+
+    def read(self, shot, member):
+        return self.zip_file.read(self.resolve(shot) + '/' + member)
+
+
+def compact_folder(folder, codec='deflate', level=None, remove=False, verify=True):
+    files = shot_zip_files(folder)
+    if len(files) <= 0:
+        LOGGER.log(logging.DEBUG, "Nothing to compact in %s" % folder)
+        return False
+    lock_file = lock_folder(folder)
+    if lock_file is None:
+        LOGGER.log(logging.INFO, "Folder %s is locked, skipped" % folder)
+        return False
+    try:
+        shot_numbers = read_shot_lists(folder)
+        # Shot zips whose members can not be matched to logged shots are never removed
+        ambiguous = set()
+        out_name = container_name(folder)
+        tmp_name = out_name + '.tmp'
+        compression = CODECS[codec]
+        index = {'version': 1, 'codec': codec, 'shots': {}}
+        keys = [fn.replace('.zip', '') for fn in files]
+        with zipfile.ZipFile(tmp_name, 'w', compression=compression, compresslevel=level) as out_zip, \
+                warnings.catch_warnings():
+            # Containers packed by earlier versions may hold duplicate names
+            warnings.filterwarnings('ignore', 'Duplicate name')
+            # Keep content of the previous container if the day was compacted before
+            if os.path.exists(out_name):
+                with zipfile.ZipFile(out_name, 'r') as old_zip:
+                    old_index = read_index(old_zip)
+                    for info in old_zip.infolist():
+                        if info.filename == INDEX_ENTRY or base_key(info.filename.partition('/')[0]) in keys:
+                            continue
+                        out_zip.writestr(info.filename, old_zip.read(info), compress_type=compression)
+                    for key in old_index['shots']:
+                        if base_key(key) not in keys:
+                            index['shots'][key] = old_index['shots'][key]
+            for fn in files:
+                numbers = shot_numbers.get(fn, [])
+                with zipfile.ZipFile(os.path.join(folder, fn), 'r') as in_zip:
+                    groups = split_members(in_zip.infolist(), numbers)
+                    if len(groups) > 1 and len(groups) != len(numbers):
+                        LOGGER.log(logging.WARNING, "%s holds %d shots, %d logged, shot numbers are not assigned" %
+                                   (fn, len(groups), len(numbers)))
+                        ambiguous.add(fn)
+                    for n, group in enumerate(groups):
+                        key = shot_key(fn.replace('.zip', ''), n)
+                        number = None
+                        if len(groups) == len(numbers):
+                            number = numbers[n]
+                        elif len(groups) == 1 and len(numbers) > 0:
+                            number = numbers[-1]
+                        index['shots'][key] = {'shot': number, 'file': fn, 'members': {}}
+                        for info in group:
+                            out_zip.writestr(key + '/' + info.filename, in_zip.read(info),
+                                             compress_type=compression)
+            # Record member offsets so that external readers can seek directly
+            for info in out_zip.infolist():
+                key, _, member = info.filename.partition('/')
+                if key in index['shots']:
+                    index['shots'][key]['members'][member] = [info.header_offset, info.compress_size,
+                                                              info.file_size, info.CRC]
+            out_zip.writestr(INDEX_ENTRY, json.dumps(index, indent=1))
+        if verify and not verify_container(tmp_name, folder, files):
+            LOGGER.log(logging.ERROR, "Verification failed for %s, sources are kept" % tmp_name)
+            os.remove(tmp_name)
+            return False
+        os.replace(tmp_name, out_name)
+        LOGGER.log(logging.INFO, "%d shot files from %s compacted into %s" % (len(files), folder, out_name))
+        if remove:
+            for fn in files:
+                if fn in ambiguous:
+                    LOGGER.log(logging.WARNING, "%s is not removed" % fn)
+                    continue
+                os.remove(os.path.join(folder, fn))
+        return True
+    except:
+        LOGGER.log(logging.ERROR, "Compaction error for %s" % folder)
+        print_exception_info()
+        return False
+    finally:
+        unlock_folder(lock_file)
+
+
+def verify_container(file_name, folder, files):
+    try:
+        with zipfile.ZipFile(file_name, 'r') as out_zip:
+            bad = out_zip.testzip()
+            if bad is not None:
+                LOGGER.log(logging.WARNING, "Corrupted member %s in %s" % (bad, file_name))
+                return False
+            # Every shot of a shot zip is compared with its own key, members in order
+            packed = {}
+            for info in out_zip.infolist():
+                packed.setdefault(info.filename.partition('/')[0], []).append(info)
+            index = read_index(out_zip)
+            shot_numbers = read_shot_lists(folder)
+            for fn in files:
+                with zipfile.ZipFile(os.path.join(folder, fn), 'r') as in_zip:
+                    groups = split_members(in_zip.infolist(), shot_numbers.get(fn))
+                if shot_key(fn.replace('.zip', ''), len(groups)) in packed:
+                    LOGGER.log(logging.WARNING, "Extra shots packed for %s" % fn)
+                    return False
+                for n, infos in enumerate(groups):
+                    key = shot_key(fn.replace('.zip', ''), n)
+                    out_infos = packed.get(key, [])
+                    if len(infos) != len(out_infos) or len(index['shots'][key]['members']) != len(infos):
+                        LOGGER.log(logging.WARNING, "Member count mismatch for %s" % key)
+                        return False
+                    for info, p in zip(infos, out_infos):
+                        if p.filename != key + '/' + info.filename or p.CRC != info.CRC or \
+                                p.file_size != info.file_size:
+                            LOGGER.log(logging.WARNING, "Member %s/%s mismatch" % (key, info.filename))
+                            return False
+        return True
+    except:
+        print_exception_info()
+        return False
+
+
+def compact(root, before=None, codec='deflate', level=None, remove=False, verify=True):
+    if before is None:
+        before = datetime.date.today()
+    count = 0
+    for folder in day_folders(root):
+        d = folder_date(folder)
+        # Only finished days are compacted
+        if d is None or d >= before:
+            continue
+        if compact_folder(folder, codec, level, remove, verify):
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROG_NAME)
+    parser.add_argument('root', help='ShotDumper output directory (outDir)')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='deflate')
+    parser.add_argument('--level', type=int, default=None, help='compression level for the codec')
+    parser.add_argument('--before', default=None, help='compact days before YYYY-MM-DD (default today)')
+    parser.add_argument('--remove', action='store_true', help='remove shot zips after verified compaction')
+    parser.add_argument('--no-verify', action='store_true')
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.INFO)
+    before_date = None
+    if args.before is not None:
+        before_date = datetime.datetime.strptime(args.before, '%Y-%m-%d').date()
+    n = compact(args.root, before_date, args.codec, args.level, args.remove, not args.no_verify)
+    LOGGER.log(logging.INFO, "%d folders compacted" % n)
+    sys.exit(0)
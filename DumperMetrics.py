@@ -0,0 +1,140 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+import http.server
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of dump latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.sources = {}
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.last_trigger = None
+        self.server = None
+        self.status_time = 0.0
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_source(self, name, func):
+        # Gauge computed at snapshot time, func() -> number
+        self.sources[name] = func
+
+    def trigger(self):
+        with self.lock:
+            self.last_trigger = time.time()
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency_counts[i] += 1
+                    break
+            self.latency_sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            result = {
+                'time': time.time(),
+                'uptime': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'dump_latency': {
+                    'buckets': [[b if b != math.inf else 'inf', c]
+                                for b, c in zip(LATENCY_BUCKETS, self.latency_counts)],
+                    'sum': self.latency_sum,
+                    'count': sum(self.latency_counts),
+                },
+                'time_since_trigger': None,
+            }
+            if self.last_trigger is not None:
+                result['time_since_trigger'] = time.time() - self.last_trigger
+        for name, func in list(self.sources.items()):
+            try:
+                result['gauges'][name] = func()
+            except:
+                result['gauges'][name] = None
+        return result
+
+    def prometheus_text(self):
+        snap = self.snapshot()
+        lines = []
+        for name, value in sorted(snap['counters'].items()):
+            lines.append('shotdumper_%s_total %s' % (name, value))
+        for name, value in sorted(snap['gauges'].items()):
+            if value is not None:
+                lines.append('shotdumper_%s %s' % (name, value))
+        n = 0
+        for bound, count in snap['dump_latency']['buckets']:
+            n += count
+            le = '+Inf' if bound == 'inf' else bound
+            lines.append('shotdumper_dump_seconds_bucket{le="%s"} %d' % (le, n))
+        lines.append('shotdumper_dump_seconds_sum %f' % snap['dump_latency']['sum'])
+        lines.append('shotdumper_dump_seconds_count %d' % snap['dump_latency']['count'])
+        if snap['time_since_trigger'] is not None:
+            lines.append('shotdumper_time_since_trigger_seconds %f' % snap['time_since_trigger'])
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port, host='127.0.0.1'):
+        if self.server is not None:
+            return
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body = metrics.prometheus_text().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    body = json.dumps(metrics.snapshot(), indent=1).encode()
+                    content_type = 'application/json'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            LOGGER.log(logging.INFO, "Metrics available at http://%s:%d/" % (host, port))
+        except:
+            self.server = None
+            LOGGER.log(logging.WARNING, "Metrics server can not be started on port %d" % port)
+            LOGGER.log(logging.DEBUG, "Exception ", exc_info=True)
+
+    def write_status(self, file_name, interval=0.0):
+        # Rewrite status file atomically, not more often than interval
+        if time.time() - self.status_time < interval:
+            return
+        self.status_time = time.time()
+        try:
+            tmp_name = file_name + '.tmp'
+            with open(tmp_name, 'w') as status_file:
+                status_file.write(json.dumps(self.snapshot(), indent=1))
+            os.replace(tmp_name, file_name)
+        except:
+            LOGGER.log(logging.WARNING, "Status file %s write error" % file_name)
+
+
+METRICS = Metrics()
@@ -0,0 +1,318 @@
+import io
+import sys
+import json
+import time
+import types
+import logging
+import argparse
+import threading
+import zipfile
+
+import numpy
+
+from ArchiveCompactor import config_logger
+from ShotExporter import find_shots, parse_text
+
+# Configure logging
+LOGGER = config_logger(__name__)
+
+PROG_NAME = "Tango Replay Backend"
+PROG_NAME_SHORT = "ReplayTango"
+PROG_VERSION = "1.0"
+
+# Attributes served by every replayed device in addition to recorded ones
+SHOT_ID = "Shot_id"
+ELAPSED = "Elapsed"
+
+
+class AttrDataFormat:
+    SCALAR = 0
+    SPECTRUM = 1
+    IMAGE = 2
+
+
+class AttrQuality:
+    ATTR_VALID = 0
+    ATTR_INVALID = 1
+
+
+class ExtractAs:
+    Numpy = 0
+    List = 1
+
+
+class DevFailed(Exception):
+    pass
+
+
+class TimeVal:
+    def __init__(self, t):
+        self.tv_sec = int(t)
+        self.tv_usec = int((t - int(t)) * 1.0e6)
+        self.tv_nsec = 0
+
+    def totime(self):
+        return self.tv_sec + 1.0e-6 * self.tv_usec
+
+
+class DeviceAttribute:
+    def __init__(self, name, value, data_format, t, quality=AttrQuality.ATTR_VALID):
+        self.name = name
+        self.value = value
+        self.data_format = data_format
+        self.quality = quality
+        self.time = TimeVal(t)
+
+
+def read_props(text):
+    props = {}
+    for line in text.splitlines():
+        if '=' in line:
+            k, v = line.split('=', 1)
+            props[k.strip()] = [v.strip()]
+    return props
+
+
+def load_shot(file_name, key=None):
+    # Recorded shot as {device: {attribute: (data_format, value, props)}}
+    devices = {}
+    prefix = '' if key is None else key + '/'
+    with zipfile.ZipFile(file_name, 'r') as zip_file:
+        names = set(zip_file.namelist())
+        for entry in names:
+            if not entry.startswith(prefix):
+                continue
+            folder, _, base = entry[len(prefix):].rpartition('/')
+            if not (base.startswith('param') and base.endswith('.txt')):
+                continue
+            label = base[len('param'):-len('.txt')]
+            props = read_props(zip_file.read(entry).decode(errors='replace'))
+            if 'Signal_Name' in props:
+                # AdlinkADC channel: Signal_Name=host:port/dev/chanyN
+                full = props.pop('Signal_Name')[0]
+                props.pop('Shot', None)
+                if ':' in full.split('/')[0]:
+                    full = full.split('/', 1)[1]
+                dev, _, attr = full.rpartition('/')
+            elif 'attribute' in props:
+                full = props.pop('attribute')[0]
+                dev, _, attr = full.rpartition('/')
+            else:
+                continue
+            data_entry = prefix + folder + '/' + label
+            attrs = devices.setdefault(dev.lower(), {})
+            if data_entry + '.json' in names:
+                meta = json.loads(zip_file.read(data_entry + '.json'))
+                chunks = [numpy.load(io.BytesIO(zip_file.read(data_entry + '/' + c))) for c in meta['chunks']]
+                attrs[attr] = (AttrDataFormat.IMAGE, numpy.concatenate(chunks), props)
+                continue
+            if data_entry + '.txt' not in names:
+                attrs[attr] = (AttrDataFormat.SCALAR, 0.0, props)
+                continue
+            text = zip_file.read(data_entry + '.txt').decode(errors='replace')
+            try:
+                a = parse_text(text)
+            except ValueError:
+                attrs[attr] = (AttrDataFormat.SCALAR, text, props)
+                continue
+            if a.shape[0] == 1 and a.shape[1] == 1 and not attr.startswith('chan'):
+                attrs[attr] = (AttrDataFormat.SCALAR, float(a[0, 0]), props)
+            elif a.shape[1] >= 2:
+                attrs[attr] = (AttrDataFormat.SPECTRUM, a[:, 1].copy(), props)
+                if attr.startswith('chany'):
+                    attrs[attr.replace('y', 'x', 1)] = (AttrDataFormat.SPECTRUM, a[:, 0].copy(), {})
+            else:
+                attrs[attr] = (AttrDataFormat.SPECTRUM, a[:, 0].copy(), props)
+    return devices
+
+
+class ReplayArchive:
+    # Recorded shots played back in recorded order.
+    # speed > 1 compresses the recorded intervals, period forces a fixed interval.
+    def __init__(self, root, first_date=None, last_date=None, speed=1.0, period=None, loop=True):
+        self.jobs = find_shots(root, first_date, last_date)
+        if len(self.jobs) <= 0:
+            raise ValueError("No recorded shots in %s" % root)
+        self.speed = speed
+        self.period = period
+        self.loop = loop
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.cache_index = None
+        self.cache = {}
+        times = numpy.array([j[1] for j in self.jobs], dtype=numpy.float64)
+        if period is not None or not numpy.all(numpy.isfinite(times)):
+            times = numpy.arange(len(self.jobs)) * (period if period is not None else 1.0)
+        self.offsets = (times - times[0]) / speed
+        # Interval before the first shot repeats after the last one
+        self.cycle = self.offsets[-1] + max(self.offsets[-1] / max(len(self.jobs) - 1, 1), 1.0 / speed)
+        LOGGER.log(logging.INFO, "%d recorded shots, replay speed %g" % (len(self.jobs), speed))
+
+    def position(self):
+        # Index of current shot, number of completed cycles and its start time
+        dt = time.time() - self.start
+        n = 0
+        if self.loop:
+            n = int(dt // self.cycle)
+            dt -= n * self.cycle
+        k = int(numpy.searchsorted(self.offsets, dt, side='right')) - 1
+        k = max(0, min(k, len(self.jobs) - 1))
+        return k, n, self.start + n * self.cycle + self.offsets[k]
+
+    def shot_id(self):
+        k, n, t = self.position()
+        return n * len(self.jobs) + k + 1
+
+    def elapsed(self):
+        k, n, t = self.position()
+        return time.time() - t
+
+    def current(self):
+        k, n, t = self.position()
+        with self.lock:
+            if self.cache_index != k:
+                shot, shot_time, file_name, key = self.jobs[k]
+                try:
+                    self.cache = load_shot(file_name, key)
+                except:
+                    LOGGER.log(logging.WARNING, "Error loading recorded shot %s" % file_name)
+                    LOGGER.log(logging.DEBUG, "Exception ", exc_info=True)
+                    self.cache = {}
+                self.cache_index = k
+            return self.cache, t
+
+
+ARCHIVE = None
+
+
+def device_name(name):
+    # Strip 'host:port/' part, tango names are case insensitive
+    parts = name.split('/')
+    if len(parts) > 3 and ':' in parts[0]:
+        parts = parts[1:]
+    return '/'.join(parts).lower()
+
+
+class DeviceProxy:
+    def __init__(self, name):
+        if ARCHIVE is None:
+            raise DevFailed("Replay archive is not installed")
+        self.name = device_name(name)
+        self.timeout = 3000
+        data, t = ARCHIVE.current()
+        if self.name not in data:
+            LOGGER.log(logging.DEBUG, "Device %s is not in current recorded shot" % self.name)
+
+    def attributes(self):
+        data, t = ARCHIVE.current()
+        return data.get(self.name, {}), t
+
+    def get_attribute_list(self):
+        attrs, t = self.attributes()
+        return list(attrs) + [SHOT_ID, ELAPSED]
+
+    def read_attribute(self, name, extract_as=None):
+        if name == SHOT_ID:
+            return DeviceAttribute(name, ARCHIVE.shot_id(), AttrDataFormat.SCALAR, time.time())
+        if name == ELAPSED:
+            return DeviceAttribute(name, ARCHIVE.elapsed(), AttrDataFormat.SCALAR, time.time())
+        attrs, t = self.attributes()
+        if name not in attrs:
+            raise DevFailed("Attribute %s/%s not found" % (self.name, name))
+        data_format, value, props = attrs[name]
+        return DeviceAttribute(name, value, data_format, t)
+
+    def read_attributes(self, names, extract_as=None):
+        return [self.read_attribute(name, extract_as) for name in names]
+
+    def set_timeout_millis(self, timeout):
+        self.timeout = timeout
+
+    def get_timeout_millis(self):
+        return self.timeout
+
+    def ping(self):
+        return 0
+
+    def is_attribute_polled(self, name):
+        return True
+
+    def get_attribute_poll_period(self, name):
+        return 100
+
+    def attribute_history(self, name, n, extract_as=None):
+        da = self.read_attribute(name, extract_as)
+        return [da] * max(int(n), 1)
+
+
+class Database:
+    def get_device_attribute_property(self, dev, names):
+        if ARCHIVE is None:
+            raise DevFailed("Replay archive is not installed")
+        data, t = ARCHIVE.current()
+        attrs = data.get(device_name(dev), {})
+        if isinstance(names, str):
+            names = [names]
+        result = {}
+        for name in names:
+            if name in attrs:
+                result[name] = dict(attrs[name][2])
+            else:
+                result[name] = {}
+        return result
+
+
+def make_module():
+    module = types.ModuleType('tango')
+    module.DeviceProxy = DeviceProxy
+    module.Database = Database
+    module.AttrDataFormat = AttrDataFormat
+    module.AttrQuality = AttrQuality
+    module.ExtractAs = ExtractAs
+    module.DevFailed = DevFailed
+    module.DeviceAttribute = DeviceAttribute
+    module._tango = types.SimpleNamespace(AttrDataFormat=AttrDataFormat, AttrQuality=AttrQuality,
+                                          ExtractAs=ExtractAs)
+    return module
+
+
+def install(archive):
+    # Must be called before ShotDumper is imported, or the tango module already
+    # imported by it is replaced as well
+    global ARCHIVE
+    ARCHIVE = archive
+    module = make_module()
+    sys.modules['tango'] = module
+    for name in ('ShotDumper', '__main__'):
+        m = sys.modules.get(name)
+        if m is not None and hasattr(m, 'tango'):
+            m.tango = module
+    return module
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROG_NAME)
+    parser.add_argument('root', help='recorded ShotDumper output directory')
+    parser.add_argument('--config', default='ShotDumperPy.json', help='ShotDumper configuration to run')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed relative to recording')
+    parser.add_argument('--period', type=float, default=None, help='fixed interval between shots, seconds')
+    parser.add_argument('--from', dest='first_date', default=None, help='first date YYYY-MM-DD')
+    parser.add_argument('--to', dest='last_date', default=None, help='last date YYYY-MM-DD')
+    parser.add_argument('--profile', default=None, help='write cProfile statistics to this file')
+    args = parser.parse_args()
+    from ShotExporter import parse_date
+    install(ReplayArchive(args.root, parse_date(args.first_date), parse_date(args.last_date),
+                          args.speed, args.period))
+    import ShotDumper
+    sd = ShotDumper.ShotDumper()
+    sd.read_config(args.config)
+    try:
+        if args.profile is not None:
+            import cProfile
+            cProfile.run('sd.process()', args.profile)
+        else:
+            sd.process()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sd.close()
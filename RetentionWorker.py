@@ -0,0 +1,260 @@
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import logging
+import datetime
+import argparse
+import zipfile
+import warnings
+
+import numpy
+
+from ArchiveCompactor import config_logger, day_folders, folder_date, lock_folder, unlock_folder, \
+    read_index, base_key, CODECS, LOCK_FILE_NAME, CONTAINER_SUFFIX, SHOT_ZIP_RE, INDEX_ENTRY
+from ShotExporter import parse_text
+
+# Configure logging
+LOGGER = config_logger(__name__)
+
+PROG_NAME = "Shot Data Retention Worker"
+PROG_NAME_SHORT = "RetentionWorker"
+PROG_VERSION = "1.0"
+
+PREVIEW_FOLDER = "preview"
+# Default policy, ages in days, None disables the step
+DEFAULT_POLICY = {
+    'recompress_days': 7,
+    'codec': 'lzma',
+    'level': None,
+    'preview_days': 30,
+    'preview_points': 2000,
+    'drop_full_days': None,
+    'cold_days': None,
+    'cold_dir': None,
+    'pause': 0.05,
+    'interval': 3600.0,
+}
+
+
+def print_exception_info(level=logging.DEBUG):
+    LOGGER.log(level, "Exception ", exc_info=True)
+
+
+def set_low_priority():
+    try:
+        if hasattr(os, 'nice'):
+            os.nice(19)
+        else:
+            import psutil
+            psutil.Process().nice(psutil.IDLE_PRIORITY_CLASS)
+    except:
+        LOGGER.log(logging.DEBUG, "Process priority can not be lowered")
+
+
+def archive_files(folder):
+    return sorted(f for f in os.listdir(folder) if SHOT_ZIP_RE.match(f) or f.endswith(CONTAINER_SUFFIX))
+
+
+def envelope(x, y, points):
+    # Min/max envelope: 'x; min; max' per bucket, keeps peaks visible at low resolution
+    n = len(y)
+    buckets = max(1, points // 2)
+    m = n // buckets
+    if m < 2:
+        return None
+    k = m * buckets
+    yb = y[:k].reshape(buckets, m)
+    xb = x[:k].reshape(buckets, m)
+    a = numpy.column_stack((xb.mean(axis=1), yb.min(axis=1), yb.max(axis=1)))
+    return '\r\n'.join('%f; %f; %f' % tuple(r) for r in a)
+
+
+def rewrite_zip(file_name, compression, level=None, transform=None):
+    # Copy zip with new compression, transform(name, data) returns [(name, data), ...]
+    tmp_name = file_name + '.tmp'
+    with zipfile.ZipFile(file_name, 'r') as in_zip, \
+            zipfile.ZipFile(tmp_name, 'w', compression=compression, compresslevel=level) as out_zip, \
+            warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Duplicate name')
+        index = None
+        for info in in_zip.infolist():
+            # Container index holds member offsets, it is rebuilt below
+            if info.filename == INDEX_ENTRY:
+                index = read_index(in_zip)
+                continue
+            data = in_zip.read(info)
+            items = [(info.filename, data)] if transform is None else transform(info.filename, data)
+            for name, d in items:
+                out_zip.writestr(name, d, compress_type=compression)
+        if index is not None:
+            for shot in index['shots'].values():
+                shot['members'] = {}
+            for info in out_zip.infolist():
+                key, _, member = info.filename.partition('/')
+                if key in index['shots']:
+                    index['shots'][key]['members'][member] = [info.header_offset, info.compress_size,
+                                                              info.file_size, info.CRC]
+            out_zip.writestr(INDEX_ENTRY, json.dumps(index, indent=1), compress_type=compression)
+    with zipfile.ZipFile(tmp_name, 'r') as check:
+        bad = check.testzip()
+    if bad is not None:
+        os.remove(tmp_name)
+        raise zipfile.BadZipFile("Corrupted member %s in %s" % (bad, tmp_name))
+    os.replace(tmp_name, file_name)
+
+
+def zip_state(file_name):
+    # Compression of the first member, names of existing previews and of full resolution signals
+    with zipfile.ZipFile(file_name, 'r') as z:
+        infos = z.infolist()
+        compression = infos[0].compress_type if infos else None
+        previews = set(i.filename for i in infos if i.filename.startswith(PREVIEW_FOLDER + '/') or
+                       ('/' + PREVIEW_FOLDER + '/') in i.filename)
+        signals = set(i.filename for i in infos if is_signal(i.filename))
+    return compression, previews, signals
+
+
+def is_signal(name):
+    base = name.rpartition('/')[2]
+    # Container members keep shot key as first path part
+    head, _, tail = name.partition('/')
+    if SHOT_ZIP_RE.match(base_key(head) + '.zip'):
+        name = tail
+    return name.endswith('.txt') and not base.startswith('param') and PREVIEW_FOLDER + '/' not in name \
+        and not name.startswith('analysis/') and base != 'missing.txt'
+
+
+def preview_name(name):
+    # Container members keep shot key as first path part
+    head, _, tail = name.partition('/')
+    if SHOT_ZIP_RE.match(base_key(head) + '.zip'):
+        return head + '/' + PREVIEW_FOLDER + '/' + tail
+    return PREVIEW_FOLDER + '/' + name
+
+
+def process_file(file_name, policy, age):
+    compression, previews, signals = zip_state(file_name)
+    target = CODECS[policy['codec']]
+    drop_age = policy['drop_full_days'] is not None and age >= policy['drop_full_days']
+    # Previews are always made before full resolution data is dropped
+    add_previews = ((policy['preview_days'] is not None and age >= policy['preview_days']) or drop_age) and \
+        len(previews) <= 0 and len(signals) > 0
+    # Signals without preview (scalars, short records) are kept
+    drop_full = drop_age and (add_previews or any(preview_name(s) in previews for s in signals))
+    recompress = policy['recompress_days'] is not None and age >= policy['recompress_days'] and \
+        compression != target
+    if not (add_previews or drop_full or recompress):
+        return False
+
+    def transform(name, data):
+        items = []
+        if not is_signal(name):
+            return [(name, data)]
+        if add_previews:
+            try:
+                a = parse_text(data)
+                if a.shape[1] >= 2:
+                    text = envelope(a[:, 0], a[:, 1], policy['preview_points'])
+                else:
+                    text = envelope(numpy.arange(len(a), dtype=numpy.float64), a[:, 0], policy['preview_points'])
+                if text is not None:
+                    items.append((preview_name(name), text))
+            except:
+                LOGGER.log(logging.DEBUG, "No preview for %s in %s" % (name, file_name))
+        # Full resolution data is dropped only when its preview exists
+        if drop_full and (len(items) > 0 or preview_name(name) in previews):
+            return items
+        return [(name, data)] + items
+
+    compression = target if (recompress or compression is None) else compression
+    rewrite_zip(file_name, compression, policy['level'] if compression == target else None, transform)
+    LOGGER.log(logging.DEBUG, "%s processed" % file_name)
+    return True
+
+
+def move_cold(folder, root, cold_root):
+    rel = os.path.relpath(folder, root)
+    dest = os.path.join(cold_root, rel)
+    if os.path.exists(dest):
+        LOGGER.log(logging.WARNING, "%s already exists, %s is not moved" % (dest, folder))
+        return None
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.move(folder, dest)
+    LOGGER.log(logging.INFO, "%s moved to %s" % (folder, dest))
+    return dest
+
+
+def run_once(root, policy, today=None):
+    if today is None:
+        today = datetime.date.today()
+    count = 0
+    for folder in day_folders(root):
+        d = folder_date(folder)
+        # Current day is never touched
+        if d is None or d >= today:
+            continue
+        age = (today - d).days
+        lock_file = lock_folder(folder)
+        if lock_file is None:
+            LOGGER.log(logging.INFO, "Folder %s is locked, skipped" % folder)
+            continue
+        cold = policy['cold_days'] is not None and policy['cold_dir'] is not None and age >= policy['cold_days']
+        dest = None
+        try:
+            for fn in archive_files(folder):
+                try:
+                    if process_file(os.path.join(folder, fn), policy, age):
+                        count += 1
+                except:
+                    LOGGER.log(logging.WARNING, "Error processing %s" % fn)
+                    print_exception_info()
+                # Yield disk and CPU to the live dumper
+                time.sleep(policy['pause'])
+            # Folder is moved locked: lock.lock stays in place and travels with it,
+            # but its handle is closed first, Windows does not rename a folder with open files
+            if cold:
+                lock_file.close()
+                try:
+                    dest = move_cold(folder, root, policy['cold_dir'])
+                except:
+                    LOGGER.log(logging.WARNING, "Error moving %s" % folder)
+                    print_exception_info()
+        finally:
+            if dest is None:
+                unlock_folder(lock_file)
+            else:
+                os.remove(os.path.join(dest, LOCK_FILE_NAME))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROG_NAME)
+    parser.add_argument('--config', default='ShotDumperPy.json',
+                        help="ShotDumper configuration with outDir and optional 'retention' section")
+    parser.add_argument('--root', default=None, help='output directory, default outDir from config')
+    parser.add_argument('--loop', action='store_true', help='run every interval seconds')
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.INFO)
+    pol = dict(DEFAULT_POLICY)
+    root_dir = args.root
+    try:
+        with open(args.config, 'r') as configfile:
+            cfg = json.loads(configfile.read())
+        pol.update(cfg.get('retention', {}))
+        if root_dir is None:
+            root_dir = cfg.get('outDir')
+    except:
+        LOGGER.log(logging.INFO, "Configuration %s is not used" % args.config)
+    if root_dir is None:
+        LOGGER.log(logging.CRITICAL, "Output directory is not defined")
+        sys.exit(1)
+    set_low_priority()
+    while True:
+        n = run_once(root_dir, pol)
+        LOGGER.log(logging.INFO, "%d files processed" % n)
+        if not args.loop:
+            break
+        time.sleep(pol['interval'])
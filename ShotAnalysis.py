@@ -0,0 +1,178 @@
+import logging
+import importlib
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy
+
+from ShotMemory import as_array, discard
+
+LOGGER = logging.getLogger(__name__)
+
+# Shot zip member of results, one per shot, as two shots may share one zip
+RESULTS_ENTRY = "analysis/results_%d.txt"
+
+
+# Built in analysis functions.
+# Each one receives x and y arrays of one signal and returns a number
+# or a dict {suffix: number}.
+
+def mean(x, y):
+    return float(numpy.mean(y))
+
+
+def rms(x, y):
+    return float(numpy.sqrt(numpy.mean(numpy.square(y, dtype=numpy.float64))))
+
+
+def integral(x, y):
+    return float(numpy.sum((y[1:] + y[:-1]) * numpy.diff(x)) / 2.0)
+
+
+def peak(x, y):
+    k = int(numpy.argmax(y))
+    return {'max': float(y[k]), 'time': float(x[k])}
+
+
+def peak2peak(x, y):
+    return float(numpy.max(y) - numpy.min(y))
+
+
+def fft_peak(x, y):
+    # Frequency and amplitude of the strongest spectral line, DC excluded
+    n = len(y)
+    if n < 4:
+        return {'freq': 0.0, 'amp': 0.0}
+    dx = (x[-1] - x[0]) / (n - 1)
+    spectrum = numpy.abs(numpy.fft.rfft(y - numpy.mean(y)))
+    k = int(numpy.argmax(spectrum[1:])) + 1
+    return {'freq': float(k / (n * dx)), 'amp': float(2.0 * spectrum[k] / n)}
+
+
+def find_function(name):
+    if '.' in name:
+        module_name, function_name = name.rsplit('.', 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    return globals()[name]
+
+
+def run_tasks(tasks, signals):
+    # Executed in a worker process
+    results = []
+    for task in tasks:
+        name = task.get('name', task['signal'] + '_' + task['function'].split('.')[-1])
+        try:
+            x, y = signals[task['signal']]
+            y = numpy.asarray(as_array(y))
+            if x is None:
+                x = numpy.arange(len(y))
+            x = as_array(x)
+            v = find_function(task['function'])(numpy.asarray(x), y, **task.get('params', {}))
+            if isinstance(v, dict):
+                for k in v:
+                    results.append((name + '_' + k, float(v[k])))
+            else:
+                results.append((name, float(v)))
+        except:
+            results.append((name, None))
+    return results
+
+
+def check_tasks(config):
+    # Raises ValueError for a task which can not run
+    for n, task in enumerate(config.get('tasks', [])):
+        for key in ('signal', 'function'):
+            if key not in task:
+                raise ValueError("analysis task %d: no '%s'" % (n, key))
+        try:
+            find_function(task['function'])
+        except:
+            raise ValueError("analysis task %d: function %s not found" % (n, task['function']))
+        if not isinstance(task.get('params', {}), dict):
+            raise ValueError("analysis task %d: 'params' must be an object" % n)
+
+
+class AnalysisPipeline:
+    def __init__(self, config):
+        self.executor = None
+        self.pending = []
+        self.configure(config)
+
+    def configure(self, config):
+        check_tasks(config)
+        self.tasks = config.get('tasks', [])
+        self.workers = config.get('workers', 2)
+        self.fmt = config.get('format', '%g')
+        self.signals = set(task['signal'] for task in self.tasks)
+
+    def wants(self, signal):
+        return signal in self.signals
+
+    def submit(self, shot, dts, folder, zip_file_name, log_file_name, signals):
+        if len(self.tasks) <= 0 or len(signals) <= 0:
+            return
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            future = self.executor.submit(run_tasks, self.tasks, signals)
+        except BrokenProcessPool:
+            # A worker died, the pool is recreated for the next shot
+            LOGGER.log(logging.WARNING, "Analysis pool is broken, no analysis for shot %d" % shot)
+            self.drop_executor()
+            discard(signals)
+            return
+        self.pending.append((future, shot, dts, folder, zip_file_name, log_file_name, signals))
+
+    def queue_length(self):
+        return len(self.pending)
+
+    def ready(self):
+        # Finished analyses in submission order, so that log lines keep shot order
+        result = []
+        while self.pending and self.pending[0][0].done():
+            future, shot, dts, folder, zip_file_name, log_file_name, signals = self.pending.pop(0)
+            discard(signals)
+            try:
+                values = future.result()
+            except BrokenProcessPool:
+                LOGGER.log(logging.WARNING, "Analysis worker died for shot %d" % shot)
+                self.drop_executor()
+                values = []
+            except:
+                LOGGER.log(logging.WARNING, "Analysis error for shot %d" % shot)
+                LOGGER.log(logging.DEBUG, "Exception ", exc_info=True)
+                values = []
+            result.append((shot, dts, folder, zip_file_name, log_file_name, values))
+        return result
+
+    def format_line(self, shot, dts, values):
+        line = '%s; Shot=%d; Analysis' % (dts, shot)
+        for name, v in values:
+            if v is None:
+                line += '; %s = nan' % name
+            else:
+                line += ('; %s = ' + self.fmt) % (name, v)
+        return line
+
+    def format_buf(self, shot, values):
+        buf = 'Shot=%d\r\n' % shot
+        for name, v in values:
+            if v is None:
+                buf += '%s=nan\r\n' % name
+            else:
+                buf += ('%s=' + self.fmt + '\r\n') % (name, v)
+        return buf
+
+    def drop_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def shutdown(self):
+        # Pending shots are abandoned, their spilled arrays removed after workers stopped
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        for p in self.pending:
+            discard(p[6])
+        self.pending = []
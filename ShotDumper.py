@@ -1,15 +1,29 @@
+import io
 import os
 import os.path
 import sys
 import json
 import logging
 import datetime
+import importlib
 import time
+import threading
 import zipfile
+import concurrent.futures
 
 import numpy
 import tango
 
+from DumperMetrics import METRICS
+from ShotAnalysis import AnalysisPipeline, check_tasks, RESULTS_ENTRY
+from ShotMemory import MemoryBudget, discard
+from SummaryTable import SummaryTable, SUMMARY_FOLDER
+from ShotLog import ShotLogWriter, last_log_shot
+
+# Plugins import TangoAttribute from ShotDumper. When this file runs as __main__
+# they must get this module and its shared state, not a second copy.
+sys.modules.setdefault('ShotDumper', sys.modules[__name__])
+
 
 def config_logger(name: str=__name__, level: int=logging.DEBUG):
     logger = logging.getLogger(name)
@@ -31,56 +45,183 @@ PROG_NAME = "PyTango Shot Dumper"
 PROG_NAME_SHORT = "ShotDumperPy"
 PROG_VERSION = "3.1"
 CONFIG_FILE_NAME = PROG_NAME_SHORT + ".json"
+# Journal records after which shot counter is saved to config file
+JOURNAL_LIMIT = 1000
 
 CONFIG = {}
 DEVICE_LIST = []
+# Post shot analysis, created if configured
+ANALYSIS = None
+# Signals of current shot requested by analysis, name: (x, y)
+SHOT_SIGNALS = {}
+# Signals which could not be read in time during current shot
+MISSING_SIGNALS = []
+# Numeric values written to the daily log during current shot, name: value
+SHOT_VALUES = {}
+# Memory accounting of arrays kept during current shot
+SHOT_MEMORY = MemoryBudget()
+# Max size of one stored chunk of IMAGE attribute, bytes
+IMAGE_CHUNK_BYTES = 1 << 20
+# Number of signal points converted to text at once
+CONVERT_CHUNK_POINTS = 1 << 16
+# Summed area table for image ROI marks is built when ROIs cover more than this part of frame
+ROI_TABLE_FRACTION = 0.5
 
 
 def print_exception_info(level=logging.DEBUG):
     LOGGER.log(level, "Exception ", exc_info=True)
 
 
-def convert_to_buf(x, y, avgc=1, fmt='%f; %f'):
-        xs = 0.0
-        ys = 0.0
-        ns = 0.0
-        fmt = fmt
-        s = ''
-        outbuf = ''
-
-        if y is None or x is None:
-            return outbuf
-        if len(y) <= 0 or len(x) <= 0:
-            return outbuf
-        n = len(y)
-        if len(y) != len(x):
-            if len(x) < n:
-                n = len(x)
-            LOGGER.log(logging.WARNING, "X and Y arrays of different length, truncated to %d" % n)
+class RetryPolicy:
+    def __init__(self, retries=3, timeout=None, backoff=0.05, backoff_factor=2.0, max_backoff=1.0):
+        # retries is the total number of attempts, timeout is tango call timeout in seconds
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+
+class ShotDeadline:
+    def __init__(self, seconds=None, end=None):
+        self.end = end
+        if seconds is not None:
+            self.end = time.time() + seconds
+
+    def remaining(self):
+        if self.end is None:
+            return float('inf')
+        return self.end - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0.0
+
+    def budget(self, seconds):
+        # Deadline for one device: its own budget but not later than the shot deadline
+        if seconds is None:
+            return ShotDeadline(end=self.end)
+        end = time.time() + seconds
+        if self.end is not None:
+            end = min(end, self.end)
+        return ShotDeadline(end=end)
+
+
+RETRY_POLICY = RetryPolicy()
+DEADLINE = ShotDeadline()
+
+
+def retry_call(func, name, counter='retries'):
+    # Call func with retries and backoff of RETRY_POLICY, but not beyond DEADLINE
+    delay = RETRY_POLICY.backoff
+    n = 0
+    while True:
+        try:
+            return func()
+        except:
+            n += 1
+            METRICS.inc(counter)
+            if n >= RETRY_POLICY.retries or DEADLINE.remaining() <= delay:
+                raise
+            LOGGER.log(logging.DEBUG, "Retry %d reading %s" % (n, name))
+            time.sleep(delay)
+            delay = min(delay * RETRY_POLICY.backoff_factor, RETRY_POLICY.max_backoff)
+
+
+def set_call_timeout(dev_proxy):
+    if RETRY_POLICY.timeout is not None:
+        dev_proxy.set_timeout_millis(int(RETRY_POLICY.timeout * 1000))
 
-        if avgc < 1:
-            avgc = 1
 
-        for i in range(n):
-            xs += x[i]
-            ys += y[i]
-            ns += 1.0
-            if ns >= avgc:
-                if i >= avgc:
-                    outbuf += '\r\n'
-                s = fmt % (xs / ns, ys / ns)
-                outbuf += s.replace(",", ".")
-                xs = 0.0
-                ys = 0.0
-                ns = 0.0
-        if ns > 0:
-            outbuf += '\r\n'
-            s = fmt % (xs / ns, ys / ns)
-            outbuf += s.replace(",", ".")
-            xs = 0.0
-            ys = 0.0
-            ns = 0.0
-        return outbuf
+def add_shot_signal(name, x, y):
+    if ANALYSIS is not None and ANALYSIS.wants(name):
+        SHOT_SIGNALS[name] = (SHOT_MEMORY.keep(x), SHOT_MEMORY.keep(y))
+
+
+def add_shot_value(name, value):
+    # Same name from several devices gets numeric suffix
+    key = name
+    k = 2
+    while key in SHOT_VALUES:
+        key = "%s_%d" % (name, k)
+        k += 1
+    try:
+        SHOT_VALUES[key] = float(value)
+    except:
+        pass
+
+
+def member_info(zip_file, entry):
+    # Streamed members get current time and archive compression, as writestr() does
+    info = zipfile.ZipInfo(entry, date_time=time.localtime()[:6])
+    info.compress_type = zip_file.compression
+    return info
+
+
+def write_chunked(zip_file, entry, n, avgc, convert):
+    # Convert and compress signal by parts, so that the full text is never kept in memory.
+    # convert(i1, i2) returns text for points i1..i2-1, chunks are aligned to avgc.
+    if avgc < 1:
+        avgc = 1
+    step = max(1, CONVERT_CHUNK_POINTS // avgc) * avgc
+    with zip_file.open(member_info(zip_file, entry), 'w') as f:
+        for i in range(0, n, step):
+            buf = convert(i, min(i + step, n))
+            if i > 0 and not buf.startswith('\r\n'):
+                buf = '\r\n' + buf
+            f.write(buf.encode())
+            SHOT_MEMORY.sample()
+
+
+def native_array(value):
+    # Contiguous native byte order view of a Tango array, copied only if needed
+    a = numpy.asarray(value)
+    if not a.dtype.isnative:
+        a = a.astype(a.dtype.newbyteorder('='))
+    return numpy.ascontiguousarray(a)
+
+
+def average(a, avgc):
+    # Means over consecutive groups of avgc points and of the incomplete last group.
+    # Sums are sequential (cumsum) in the type of 0.0 + point, as the former per point loop did.
+    acc = numpy.dtype(type(0.0 + a.dtype.type(0)))
+    m = len(a) // avgc * avgc
+    if avgc == 1:
+        full = a.astype(acc, copy=False)
+    else:
+        full = numpy.cumsum(a[:m].reshape(-1, avgc), axis=1, dtype=acc)[:, -1] / acc.type(avgc)
+    tail = None
+    if m < len(a):
+        tail = numpy.cumsum(a[m:], dtype=acc)[-1] / acc.type(len(a) - m)
+    return full, tail
+
+
+def format_averaged(fmt, avgc, *columns):
+    # Text lines of column means separated by '\r\n'. The incomplete last group
+    # always gets a leading separator, so a signal shorter than avgc starts with '\r\n'.
+    means = [average(c, avgc) for c in columns]
+    n = len(means[0][0])
+    outbuf = ''
+    if n > 0:
+        values = numpy.column_stack([full for full, tail in means]).ravel().tolist()
+        outbuf = '\r\n'.join([fmt] * n) % tuple(values)
+    if means[0][1] is not None:
+        outbuf += '\r\n' + fmt % tuple(float(tail) for full, tail in means)
+    return outbuf
+
+
+def convert_to_buf(x, y, avgc=1, fmt='%f; %f'):
+    if y is None or x is None:
+        return ''
+    if len(y) <= 0 or len(x) <= 0:
+        return ''
+    n = len(y)
+    if len(y) != len(x):
+        if len(x) < n:
+            n = len(x)
+        LOGGER.log(logging.WARNING, "X and Y arrays of different length, truncated to %d" % n)
+    if avgc < 1:
+        avgc = 1
+    return format_averaged(fmt, avgc, native_array(x)[:n], native_array(y)[:n])
 
 
 class TestDevice:
@@ -121,15 +262,20 @@ class TestDevice:
     def save(self, log_file, zip_file):
         LOGGER.log(logging.DEBUG, "TestDevice %d - Save" % self.n)
         log_file.write('; TestDev_%d=%f'%(self.n, self.time))
+        add_shot_value('TestDev_%d' % self.n, self.time)
         if self.points > 0:
+            t = time.time()
+            x = numpy.arange(self.points, dtype=numpy.float64)
+            y = numpy.sin(t + float(self.n) + x / 100.0) + 0.1 * numpy.sin(t + x / 5.0)
             buf = ""
             for k in range(self.points):
-                s = '%f; %f' % (float(k), numpy.sin(time.time()+float(self.n)+float(k)/100.0)+0.1*numpy.sin(time.time()+float(k)/5.0))
+                s = '%f; %f' % (x[k], y[k])
                 buf += s.replace(",", ".")
                 if k < self.points-1:
                     buf += '\r\n'
             entry = "TestDev/chanTestDev_%d.txt" % self.n
             zip_file.writestr(entry, buf)
+            add_shot_signal("TestDev/chanTestDev_%d" % self.n, x, y)
             entry = "TestDev/paramchanTestDev_%d.txt" % self.n
             text = "name=TestDev_%d\r\nxlabel=Point number" % self.n
             text += '\r\n' + str(self.parameters)
@@ -155,7 +301,7 @@ class AdlinkADC:
             return self.prop
 
         def read_data(self):
-            self.attr = self.dev.devProxy.read_attribute(self.name)
+            self.attr = self.dev.devProxy.read_attribute(self.name, extract_as=tango.ExtractAs.Numpy)
             return self.attr.value
 
         def read_x_data(self):
@@ -165,7 +311,8 @@ class AdlinkADC:
                 # Generate 1 increment array as x
                 self.x_data = numpy.arange(len(self.attr.value))
             else:
-                self.x_data = self.dev.devProxy.read_attribute(self.name.replace('y', 'x')).value
+                self.x_data = self.dev.devProxy.read_attribute(self.name.replace('y', 'x'),
+                                                               extract_as=tango.ExtractAs.Numpy).value
             return self.x_data
 
         def get_prop_as_boolean(self, propName):
@@ -217,6 +364,14 @@ class AdlinkADC:
             if self.x_data is None:
                 self.read_x_data()
             ml = {}
+            # Marks are means over views of the read array, nothing is copied
+            y = numpy.asarray(self.attr.value)
+            try:
+                x0 = self.x_data[0]
+                dx = self.x_data[1] - x0
+            except:
+                x0 = 0.0
+                dx = 0.0
             for pk in self.prop:
                 if pk.endswith("_start"):
                     pn = pk.replace("_start", "")
@@ -227,10 +382,9 @@ class AdlinkADC:
                             pl = int(self.prop[pln][0])
                         else:
                             pl = 1
-                        dx = self.x_data[1] - self.x_data[0]
-                        n1 = int((pv - self.x_data[0]) / dx)
-                        n2 = int((pv +  pl - self.x_data[0]) / dx)
-                        ml[pn] = self.attr.value[n1:n2].mean()
+                        n1 = int((pv - x0) / dx)
+                        n2 = int((pv +  pl - x0) / dx)
+                        ml[pn] = y[n1:n2].mean()
                     except:
                         ml[pn] = 0.0
             return ml
@@ -260,6 +414,7 @@ class AdlinkADC:
             try:
                 self.db = tango.Database()
                 self.devProxy = tango.DeviceProxy(self.get_name())
+                set_call_timeout(self.devProxy)
                 self.active = True
                 LOGGER.log(logging.DEBUG, "ADC %s activated" % self.get_name())
             except:
@@ -303,12 +458,16 @@ class AdlinkADC:
     def save_data(self, zip_file, chan):
         entry = chan.dev.folder + "/" + chan.name + ".txt"
         avg = chan.get_prop_as_int("save_avg")
-        if avg < 1:
+        if avg is None or avg < 1:
             avg = 1
         if chan.x_data is None or len(chan.x_data) != len(chan.attr.value):
             chan.x_data = chan.read_x_data()
-        buf = convert_to_buf(chan.x_data, chan.attr.value, avg)
-        zip_file.writestr(entry, buf)
+        x = chan.x_data
+        y = chan.attr.value
+        n = min(len(x), len(y))
+        if len(x) != len(y):
+            LOGGER.log(logging.WARNING, "X and Y arrays of different length, truncated to %d" % n)
+        write_chunked(zip_file, entry, n, avg, lambda i1, i2: convert_to_buf(x[i1:i2], y[i1:i2], avg))
 
     def save_prop(self, zip_file, chan):
         entry = chan.dev.folder + "/" + "param" + chan.name + ".txt"
@@ -372,41 +531,49 @@ class AdlinkADC:
                     format = '%6.2f'
                 outstr = "; %s = "%mark_name + format%mark_value + " %s"%unit
                 log_file.write(outstr)
-        outstr = "; SHOT_TIME = %f" % self.read_shot_time()
+                add_shot_value(mark_name, mark_value)
+        shot_time = self.read_shot_time()
+        outstr = "; SHOT_TIME = %f" % shot_time
         log_file.write(outstr)
+        add_shot_value("SHOT_TIME", shot_time)
 
     def save(self, log_file, zip_file):
-        atts = self.devProxy.get_attribute_list()
+        atts = retry_call(self.devProxy.get_attribute_list, self.get_name(), 'channel_retries')
         self.x_data = None
         for a in atts:
             if a.startswith("chany"):
-                retry_count = 3
-                while retry_count > 0:
-                    try:
-                        chan = AdlinkADC.Channel(self, a)
-                        # Read save_data and save_log flags
-                        sdf = chan.get_prop_as_boolean("save_data")
-                        slf = chan.get_prop_as_boolean("save_log")
-                        # Save signal properties
-                        if sdf or slf:
-                            self.save_prop(zip_file, chan)
-                            chan.read_data()
-                            self.save_log(log_file, chan)
-                            if sdf:
-                                self.save_data(zip_file, chan)
-                        break
-                    except:
-                        LOGGER.log(logging.WARNING, "Adlink %s data save exception" % self.get_name())
-                        print_exception_info()
-                        retry_count -= 1
-                    if retry_count > 0:
-                        LOGGER.log(logging.DEBUG, "Retry reading channel %s" % self.get_name())
-                    if retry_count == 0:
-                        LOGGER.log(logging.WARNING, "Error reading channel %s" % self.get_name())
+                if DEADLINE.expired():
+                    MISSING_SIGNALS.append(self.folder + "/" + a)
+                    continue
+                chan = AdlinkADC.Channel(self, a)
+                name = "%s/%s" % (self.get_name(), a)
+                try:
+                    # Each step is retried separately, so only the failed read is repeated
+                    retry_call(chan.read_properties, name, 'channel_retries')
+                    # Read save_data and save_log flags
+                    sdf = chan.get_prop_as_boolean("save_data")
+                    slf = chan.get_prop_as_boolean("save_log")
+                    # Save signal properties
+                    if sdf or slf:
+                        self.save_prop(zip_file, chan)
+                        retry_call(chan.read_data, name, 'channel_retries')
+                        retry_call(chan.read_x_data, name, 'channel_retries')
+                        self.save_log(log_file, chan)
+                        add_shot_signal(self.folder + "/" + chan.name, chan.x_data, chan.attr.value)
+                        if sdf:
+                            self.save_data(zip_file, chan)
+                    # Release raw arrays as soon as they are stored
+                    chan.attr = None
+                    chan.x_data = None
+                except:
+                    METRICS.inc('channel_read_failures')
+                    MISSING_SIGNALS.append(self.folder + "/" + a)
+                    LOGGER.log(logging.WARNING, "Error reading channel %s" % name)
+                    print_exception_info()
 
 
 class TangoAttribute:
-    def __init__(self, device, attribute_name, folder=None, force=True, ahead=None):
+    def __init__(self, device, attribute_name, folder=None, force=True, ahead=None, avg=None):
         self.dev = device
         self.name = attribute_name
         self.folder = folder
@@ -414,7 +581,8 @@ class TangoAttribute:
             self.folder = "%s/%s" % (self.dev, self.name)
         self.force = force
         self.ahead = ahead
-        self.retry_count = 3
+        # averaging for saved data, overrides 'save_avg' attribute property
+        self.avg = avg
         self.active = False
         self.time = time.time()
         # tango related
@@ -478,13 +646,13 @@ class TangoAttribute:
         return self.prop
 
     def read_attribute(self):
-        self.attr = self.devProxy.read_attribute(self.name)
+        self.attr = self.devProxy.read_attribute(self.name, extract_as=tango.ExtractAs.Numpy)
         self.time = time.time()
         try:
             if self.ahead is not None and self.devProxy.is_attribute_polled(self.name):
                 period = self.devProxy.get_attribute_poll_period(self.name)
                 n = self.ahead / period + 1
-                history = self.devProxy.attribute_history(self.name, n)
+                history = self.devProxy.attribute_history(self.name, n, extract_as=tango.ExtractAs.Numpy)
                 t = history[0].time.tv_sec + (1.0e-6 * history[0].time.tv_usec) + (1.0e-9 * history[0].time.tv_nsec)
                 if time.time() - t >= (self.ahead - 0.1):
                     self.attr = history[0]
@@ -506,6 +674,7 @@ class TangoAttribute:
         try:
             self.db = tango.Database()
             self.devProxy = tango.DeviceProxy(self.dev)
+            set_call_timeout(self.devProxy)
             self.time = time.time()
             self.active = True
             LOGGER.log(logging.DEBUG, "Device %s activated" % self.dev)
@@ -520,65 +689,23 @@ class TangoAttribute:
         return False
 
     def convert_to_buf(self, avgc, y=None, x=None):
-        outbuf = ''
         if avgc < 1:
             avgc = 1
-
+        if y is None:
+            y = self.attr.value
         if x is None:
             # save only y values
-            fmt = '%f'
-            if y is None:
-                y = self.attr.value
-            n = len(y)
-            ys = 0.0
-            ns = 0.0
-            for k in range(n):
-                ys += y[k]
-                ns += 1.0
-                if ns >= avgc:
-                    if k >= avgc:
-                        outbuf += '\r\n'
-                    s = fmt % (ys / ns)
-                    outbuf += s.replace(",", ".")
-                    ys = 0.0
-                    ns = 0.0
-            if ns > 0:
-                outbuf += '\r\n'
-                s = fmt % (ys / ns)
-                outbuf += s.replace(",", ".")
-        else:
-            # save "x; y" pairs
-            fmt = '%f; %f'
-            if y is None:
-                y = self.attr.value
-            if y is None:
-                return ''
-            if len(y) <= 0 or len(x) <= 0:
-                return ''
-            n = len(y)
-            if len(x) < n:
-                n = len(x)
-                LOGGER.log(logging.WARNING, "X and Y arrays of different length, truncated to %d" % n)
-            xs = 0.0
-            ys = 0.0
-            ns = 0.0
-            for k in range(n):
-                xs += x[k]
-                ys += y[k]
-                ns += 1.0
-                if ns >= avgc:
-                    if k >= avgc:
-                        outbuf += '\r\n'
-                    s = fmt % (xs / ns, ys / ns)
-                    outbuf += s.replace(",", ".")
-                    xs = 0.0
-                    ys = 0.0
-                    ns = 0.0
-            if ns > 0:
-                outbuf += '\r\n'
-                s = fmt % (xs / ns, ys / ns)
-                outbuf += s.replace(",", ".")
-        return outbuf
+            return format_averaged('%f', avgc, native_array(y))
+        # save "x; y" pairs
+        if y is None:
+            return ''
+        if len(y) <= 0 or len(x) <= 0:
+            return ''
+        n = len(y)
+        if len(x) < n:
+            n = len(x)
+            LOGGER.log(logging.WARNING, "X and Y arrays of different length, truncated to %d" % n)
+        return format_averaged('%f; %f', avgc, native_array(x)[:n], native_array(y)[:n])
 
     def get_marks(self):
         if self.prop is None:
@@ -586,6 +713,7 @@ class TangoAttribute:
         if self.attr is None:
             self.read_attribute()
         ml = {}
+        y = numpy.asarray(self.attr.value)
         for pk in self.prop:
             if pk.endswith("_start"):
                 pn = pk.replace("_start", "")
@@ -596,15 +724,109 @@ class TangoAttribute:
                         pl = int(self.prop[pln][0])
                     else:
                         pl = 1
-                    ml[pn] = self.attr.value[pv:pv + pl].mean()
+                    ml[pn] = y[pv:pv + pl].mean()
                 except:
                     ml[pn] = 0.0
         return ml
 
+    def get_image_marks(self):
+        # Window means over 2D regions, property '<mark>_roi' = 'x, y, width, height'.
+        # Each region is averaged over its own pixels. A summed area table costs a float64
+        # copy of the whole frame, so it is used only when regions cover most of the frame.
+        if self.prop is None:
+            self.read_all_properties()
+        frame = numpy.asarray(self.attr.value)
+        names = []
+        rois = []
+        for pk in self.prop:
+            if pk.endswith("_roi"):
+                try:
+                    x, y, w, h = [int(v) for v in self.prop[pk][0].replace(';', ',').split(',')]
+                    x0 = min(max(x, 0), frame.shape[1])
+                    y0 = min(max(y, 0), frame.shape[0])
+                    x1 = min(max(x + w, x0), frame.shape[1])
+                    y1 = min(max(y + h, y0), frame.shape[0])
+                    names.append(pk.replace("_roi", ""))
+                    rois.append((x0, y0, x1, y1))
+                except:
+                    LOGGER.log(logging.DEBUG, "Wrong ROI %s for %s" % (pk, self.get_name()))
+        ml = {}
+        if len(rois) <= 0:
+            return ml
+        r = numpy.array(rois)
+        area = (r[:, 2] - r[:, 0]) * (r[:, 3] - r[:, 1])
+        if area.sum() > ROI_TABLE_FRACTION * frame.shape[0] * frame.shape[1]:
+            table = numpy.zeros((frame.shape[0] + 1, frame.shape[1] + 1), dtype=numpy.float64)
+            numpy.cumsum(frame, axis=0, dtype=numpy.float64, out=table[1:, 1:])
+            numpy.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+            sums = table[r[:, 3], r[:, 2]] - table[r[:, 1], r[:, 2]] - table[r[:, 3], r[:, 0]] + table[r[:, 1], r[:, 0]]
+            means = numpy.divide(sums, area, out=numpy.zeros(len(rois)), where=area > 0)
+        else:
+            means = [frame[y0:y1, x0:x1].mean(dtype=numpy.float64) if x1 > x0 and y1 > y0 else 0.0
+                     for x0, y0, x1, y1 in rois]
+        for name, v in zip(names, means):
+            ml[name] = float(v)
+        return ml
+
+    def get_thumbnail(self, k):
+        # Decimated copy of the frame, mean over k x k blocks
+        frame = numpy.asarray(self.attr.value)
+        ny = frame.shape[0] // k
+        nx = frame.shape[1] // k
+        if nx <= 0 or ny <= 0:
+            return frame.astype(numpy.float32)
+        blocks = frame[:ny * k, :nx * k].reshape(ny, k, nx, k)
+        return blocks.mean(axis=(1, 3), dtype=numpy.float64).astype(numpy.float32)
+
+    def unique_entry(self, zip_file, name):
+        entry = self.folder + "/" + name
+        try:
+            zip_file.getinfo(entry)
+            self.folder += ("_" + self.dev + '_' + str(time.time()))
+            self.folder = self.folder.replace('/', '_')
+            self.folder = self.folder.replace('.', '_')
+            LOGGER.log(logging.WARNING, "Duplicate entry %s in zip file. Folder is changed to %s" % (entry, self.folder))
+            entry = self.folder + "/" + name
+        except KeyError:
+            pass
+        return entry
+
+    def save_image(self, zip_file:zipfile.ZipFile):
+        # Frame is stored as row chunks in .npy format, dtype and shape are in the .json entry
+        frame = numpy.ascontiguousarray(self.attr.value)
+        meta_entry = self.unique_entry(zip_file, self.label + ".json")
+        base = meta_entry[:-len(".json")]
+        row_bytes = max(frame.strides[0], 1)
+        chunk_rows = max(1, IMAGE_CHUNK_BYTES // row_bytes)
+        chunks = []
+        for n, k in enumerate(range(0, frame.shape[0], chunk_rows)):
+            entry = "%s/%03d.npy" % (base, n)
+            with zip_file.open(member_info(zip_file, entry), 'w') as f:
+                numpy.lib.format.write_array(f, frame[k:k + chunk_rows], allow_pickle=False)
+            SHOT_MEMORY.sample()
+            chunks.append(entry.split('/')[-1])
+        meta = {
+            'attribute': self.get_name(),
+            'dtype': frame.dtype.str,
+            'shape': list(frame.shape),
+            'chunk_rows': chunk_rows,
+            'chunks': chunks,
+        }
+        k = self.get_prop_as_int("thumbnail")
+        if k is not None and k > 1:
+            entry = base + "_thumbnail.npy"
+            with zip_file.open(member_info(zip_file, entry), 'w') as f:
+                numpy.lib.format.write_array(f, self.get_thumbnail(k), allow_pickle=False)
+            meta['thumbnail'] = entry.split('/')[-1]
+            meta['thumbnail_step'] = k
+        zip_file.writestr(meta_entry, json.dumps(meta, indent=1))
+
     def save_log(self, log_file):
         try:
             if self.attr.data_format == tango._tango.AttrDataFormat.SCALAR:
                 v = self.attr.value
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    add_shot_value(self.label, v * self.coeff)
                 if isinstance(v, (int, float, complex)) and not isinstance(v, bool):
                     v = self.fmt % (v * self.coeff)
                 else:
@@ -648,10 +870,29 @@ class TangoAttribute:
 
                         outstr = ('; %s = ' + self.fmt + ' %s') % (mark_name, mark_value * self.coeff, self.unit)
                         log_file.write(outstr)
+                        add_shot_value(mark_name, mark_value * self.coeff)
                 if len(self.marks) <= 0:
                     v = (float(self.attr.value[0]) - zero) * self.coeff
                     outstr = ('; %s = ' + self.fmt + ' %s') % (self.label, v, self.unit)
                     log_file.write(outstr)
+                    add_shot_value(self.label, v)
+            elif self.attr.data_format == tango._tango.AttrDataFormat.IMAGE:
+                self.marks = self.get_image_marks()
+                zero = self.marks.pop("zero", 0.0)
+                for mark in self.marks:
+                    mark_name = mark
+                    if mark_name == "mark":
+                        mark_name = self.label
+                    mark_value = (self.marks[mark] - zero) * self.coeff
+                    outstr = ('; %s = ' + self.fmt + ' %s') % (mark_name, mark_value, self.unit)
+                    log_file.write(outstr)
+                    add_shot_value(mark_name, mark_value)
+                    print(outstr[2:])
+                if len(self.marks) <= 0:
+                    v = float(numpy.mean(self.attr.value)) * self.coeff
+                    outstr = ('; %s = ' + self.fmt + ' %s') % (self.label, v, self.unit)
+                    log_file.write(outstr)
+                    add_shot_value(self.label, v)
             else:
                 return
         except:
@@ -660,14 +901,11 @@ class TangoAttribute:
     def save_data(self, zip_file:zipfile.ZipFile):
         entry = self.folder + "/" + self.label + ".txt"
         try:
-            if self.attr.data_format == tango._tango.AttrDataFormat.SCALAR:
-                buf = str(self.attr.value)
-            elif self.attr.data_format == tango._tango.AttrDataFormat.SPECTRUM:
-                avg = self.get_prop_as_int("save_avg")
-                if avg < 1:
-                    avg = 1
-                buf = self.convert_to_buf(avg)
-            else:
+            if self.attr.data_format == tango._tango.AttrDataFormat.IMAGE:
+                self.save_image(zip_file)
+                return
+            if self.attr.data_format not in (tango._tango.AttrDataFormat.SCALAR,
+                                             tango._tango.AttrDataFormat.SPECTRUM):
                 LOGGER.log(logging.WARNING, "Unsupported attribute format for %s" % self.get_name())
                 return
             try:
@@ -679,7 +917,16 @@ class TangoAttribute:
                 entry = self.folder + "/" + self.label + ".txt"
             except:
                 pass
-            zip_file.writestr(entry, buf)
+            if self.attr.data_format == tango._tango.AttrDataFormat.SCALAR:
+                zip_file.writestr(entry, str(self.attr.value))
+            else:
+                avg = self.avg
+                if avg is None:
+                    avg = self.get_prop_as_int("save_avg")
+                if avg is None or avg < 1:
+                    avg = 1
+                y = self.attr.value
+                write_chunked(zip_file, entry, len(y), avg, lambda i1, i2: self.convert_to_buf(avg, y[i1:i2]))
         except:
             LOGGER.log(logging.WARNING, "Attribute data save error for %s" % self.get_name())
 
@@ -701,7 +948,13 @@ class TangoAttribute:
         zip_file.writestr(entry, buf)
 
     def save(self, log_file, zip_file):
-        self.read_all_properties()
+        try:
+            retry_call(self.read_all_properties, self.get_name(), 'attribute_retries')
+        except:
+            METRICS.inc('attribute_read_failures')
+            MISSING_SIGNALS.append(self.get_name())
+            LOGGER.log(logging.WARNING, "Properties can not be read for %s" % self.get_name())
+            return
         # label
         self.label = self.get_property('label')
         if self.label is None or '' == self.label:
@@ -719,17 +972,13 @@ class TangoAttribute:
         if not (self.sdf or self.slf):
             return
         # read attribute with retries
-        rc = self.retry_count
-        while rc > 0:
-            try:
-                self.read_attribute()
-                self.time = time.time()
-                break
-            except:
-                LOGGER.log(logging.DEBUG, "Attribute %s read exception" % self.get_name())
-                print_exception_info()
-                rc -= 1
-        if rc == 0:
+        try:
+            retry_call(self.read_attribute, self.get_name(), 'attribute_retries')
+            self.time = time.time()
+        except:
+            print_exception_info()
+            METRICS.inc('attribute_read_failures')
+            MISSING_SIGNALS.append(self.get_name())
             LOGGER.log(logging.WARNING, "Retry count exceeded reading attribute %s" % self.get_name())
             self.active = False
             self.time = time.time()
@@ -739,6 +988,8 @@ class TangoAttribute:
             LOGGER.log(logging.DEBUG, "Scalar attribute %s" % self.name)
         elif self.attr.data_format == tango._tango.AttrDataFormat.SPECTRUM:
             LOGGER.log(logging.DEBUG, "SPECRUM attribute %s" % self.name)
+        elif self.attr.data_format == tango._tango.AttrDataFormat.IMAGE:
+            LOGGER.log(logging.DEBUG, "IMAGE attribute %s" % self.name)
         else:
             LOGGER.log(logging.WARNING, "Unsupported attribute format for %s" % self.name)
             raise ValueError
@@ -763,12 +1014,174 @@ class TangoAttribute:
         if self.fmt is None or '' == self.fmt:
             self.fmt = '%6.2f'
 
+        if self.attr.data_format == tango._tango.AttrDataFormat.SPECTRUM:
+            add_shot_signal(self.folder + "/" + self.label, None, self.attr.value)
+
         if self.sdf or self.slf:
             self.save_prop(zip_file)
         if self.slf:
             self.save_log(log_file)
         if self.sdf:
             self.save_data(zip_file)
+        # Release raw value as soon as it is stored
+        self.attr = None
+
+# Device types for declarative configuration entries {"type": ..., ...}.
+# Values are names of classes in this module or 'module.Class' strings
+# of plugins, imported on first use.
+DEVICE_TYPES = {
+    'TestDevice': 'TestDevice',
+    'AdlinkADC': 'AdlinkADC',
+    'TangoAttribute': 'TangoAttribute',
+    'maxhistory': 'maxhistory.TangoAttributemax',
+    'peak2peak': 'peak2peak.TangoAttributepeak2peak',
+}
+# TangoAttribute 'reducer' option selects plugin type
+REDUCERS = {
+    'max': 'maxhistory',
+    'maxhistory': 'maxhistory',
+    'peak2peak': 'peak2peak',
+}
+# Configuration key: (constructor argument, allowed types, required)
+_ATTRIBUTE_SCHEMA = {
+    'device': ('device', (str,), True),
+    'attribute': ('attribute_name', (str,), True),
+    'folder': ('folder', (str,), False),
+    'force': ('force', (bool,), False),
+    'ahead': ('ahead', (int, float), False),
+    'avg': ('avg', (int,), False),
+    'reducer': (None, (str,), False),
+    'budget': (None, (int, float), False),
+}
+DEVICE_SCHEMA = {
+    'TestDevice': {
+        'delta_t': ('delta_t', (int, float), False),
+        'points': ('points', (int,), False),
+        'parameters': ('parameters', (str, list), False),
+        'budget': (None, (int, float), False),
+    },
+    'AdlinkADC': {
+        'host': ('host', (str,), False),
+        'port': ('port', (int,), False),
+        'device': ('dev', (str,), False),
+        'avg': ('avg', (int,), False),
+        'folder': ('folder', (str,), False),
+        'first': ('first', (bool,), False),
+        'budget': (None, (int, float), False),
+    },
+    'TangoAttribute': _ATTRIBUTE_SCHEMA,
+    'maxhistory': _ATTRIBUTE_SCHEMA,
+    'peak2peak': _ATTRIBUTE_SCHEMA,
+}
+_DEVICE_CLASSES = {}
+
+
+def build_config_options(config):
+    # Objects built from config options, raises on a wrong option
+    options = {}
+    opt = config.get('durability', {})
+    if not isinstance(opt, dict):
+        raise ValueError("'durability' must be an object")
+    options['retry'] = RetryPolicy(**config.get('retry', {}))
+    opt = config.get('memory', {})
+    limit = opt.get('budget_mb')
+    if limit is not None:
+        limit = int(limit * 1024 * 1024)
+    options['memory'] = MemoryBudget(limit, opt.get('spill_dir'))
+    if 'analysis' in config:
+        check_tasks(config['analysis'])
+    return options
+
+
+def activate_item(item):
+    # Executed in activation pool, returns (success, connect time)
+    t0 = time.time()
+    try:
+        ok = bool(item.activate())
+    except:
+        LOGGER.log(logging.ERROR, "Device %s activation error" % item.get_name())
+        print_exception_info()
+        ok = False
+    return ok, time.time() - t0
+
+
+def device_type_name(unit):
+    type_name = unit['type']
+    if 'reducer' in unit and type_name == 'TangoAttribute':
+        type_name = REDUCERS.get(unit['reducer'], type_name)
+    return type_name
+
+
+def get_device_class(type_name):
+    if type_name in _DEVICE_CLASSES:
+        return _DEVICE_CLASSES[type_name]
+    path = DEVICE_TYPES[type_name]
+    if '.' in path:
+        module_name, class_name = path.rsplit('.', 1)
+        cls = getattr(importlib.import_module(module_name), class_name)
+    else:
+        cls = globals()[path]
+    _DEVICE_CLASSES[type_name] = cls
+    return cls
+
+
+def validate_device(unit):
+    # Static check of one 'devices' entry, nothing is imported or connected
+    errors = []
+    if not isinstance(unit, dict):
+        return ['entry is not an object']
+    if 'type' not in unit:
+        if 'eval' not in unit:
+            errors.append("neither 'type' nor 'eval' option")
+        for k in ('exec', 'eval'):
+            if k in unit:
+                try:
+                    compile(unit[k], '<%s>' % k, k)
+                except SyntaxError as ex:
+                    errors.append("'%s' syntax error: %s" % (k, ex.msg))
+        return errors
+    type_name = unit['type']
+    if type_name not in DEVICE_TYPES:
+        return ["unknown device type '%s'" % type_name]
+    if 'reducer' in unit and unit['reducer'] not in REDUCERS:
+        errors.append("unknown reducer '%s'" % unit['reducer'])
+    schema = DEVICE_SCHEMA.get(type_name, {})
+    for key in unit:
+        if key == 'type':
+            continue
+        if key not in schema:
+            errors.append("unknown option '%s' for %s" % (key, type_name))
+            continue
+        types = schema[key][1]
+        v = unit[key]
+        if not isinstance(v, types) or (isinstance(v, bool) and bool not in types):
+            errors.append("option '%s' has wrong type %s" % (key, type(v).__name__))
+    for key in schema:
+        if schema[key][2] and key not in unit:
+            errors.append("option '%s' is required for %s" % (key, type_name))
+    return errors
+
+
+def validate_config(config):
+    errors = []
+    for n, unit in enumerate(config.get('devices', [])):
+        for e in validate_device(unit):
+            errors.append("device %d: %s" % (n, e))
+    return errors
+
+
+def build_device(unit):
+    type_name = device_type_name(unit)
+    schema = DEVICE_SCHEMA.get(type_name, {})
+    kwargs = {}
+    for key in unit:
+        if key in schema and schema[key][0] is not None:
+            kwargs[schema[key][0]] = unit[key]
+    item = get_device_class(type_name)(**kwargs)
+    # Per device time budget for saving one shot, seconds
+    if 'budget' in unit:
+        item.budget = unit['budget']
+    return item
 
 
 class ShotDumper:
@@ -779,6 +1192,18 @@ class ShotDumper:
         self.shot = 0
         self.logFile = None
         self.zipFile = None
+        self.config_file_name = CONFIG_FILE_NAME
+        self.config_mtime = None
+        self.device_keys = {}
+        self.reload_thread = None
+        self.reload_result = None
+        self.summary = None
+        self.log_writer = None
+        self.analysis_postponed = []
+        # Device activation runs in a thread pool, failed devices are retried in background
+        self.activation_pool = None
+        self.activations = {}
+        self.retry_time = {}
 
     def read_config(self, file_name=CONFIG_FILE_NAME):
         global CONFIG
@@ -788,19 +1213,13 @@ class ShotDumper:
             with open(file_name, 'r') as configfile:
                 s = configfile.read()
             CONFIG = json.loads(s)
-            # Restore log level
-            try:
-                LOGGER.setLevel(CONFIG['Loglevel'])
-            except:
-                LOGGER.setLevel(logging.DEBUG)
-            LOGGER.log(logging.DEBUG, "Log level set to %d" % LOGGER.level)
-            if 'sleep' not in CONFIG:
-                CONFIG["sleep"] = 1.0
-            # Read output directory
-            if 'outDir' in CONFIG:
-                self.outRootDir = CONFIG["outDir"]
+            self.config_file_name = file_name
+            self.config_mtime = self.get_config_mtime()
+            self.log_writer = ShotLogWriter(os.path.splitext(file_name)[0] + ".journal")
+            self.apply_config_options()
             if 'shot' in CONFIG:
                 self.shot = CONFIG['shot']
+            self.recover_state()
             # Restore devices
             if 'devices' not in CONFIG:
                 LOGGER.log(logging.WARNING, "No devices declared")
@@ -810,19 +1229,11 @@ class ShotDumper:
             if len(items) <= 0:
                 LOGGER.error("No devices declared")
                 return
-            for unit in items:
-                try:
-                    if 'exec' in unit:
-                        exec(unit["exec"])
-                    if 'eval' in unit:
-                        item = eval(unit["eval"])
-                        DEVICE_LIST.append(item)
-                        LOGGER.info("%s has been added" % str(unit["eval"]))
-                    else:
-                        LOGGER.debug("No 'eval' option for device %s" % unit)
-                except:
-                    LOGGER.log(logging.WARNING, "Error in device processing %s" % str(unit))
-                    print_exception_info()
+            for key, unit in self.device_keys_for(items):
+                item = self.create_device(unit)
+                if item is not None:
+                    DEVICE_LIST.append(item)
+                    self.device_keys[key] = item
             LOGGER.info('Configuration restored from %s' % file_name)
             return True
         except:
@@ -830,13 +1241,222 @@ class ShotDumper:
             print_exception_info()
             return False
 
+    def apply_config_options(self, options=None):
+        global ANALYSIS
+        global RETRY_POLICY
+        global SHOT_MEMORY
+        if options is None:
+            options = build_config_options(CONFIG)
+        # Restore log level
+        try:
+            LOGGER.setLevel(CONFIG['Loglevel'])
+        except:
+            LOGGER.setLevel(logging.DEBUG)
+        LOGGER.log(logging.DEBUG, "Log level set to %d" % LOGGER.level)
+        if 'sleep' not in CONFIG:
+            CONFIG["sleep"] = 1.0
+        # Read output directory
+        if 'outDir' in CONFIG:
+            self.outRootDir = CONFIG["outDir"]
+        # fsync policy of daily log and shot journal
+        if self.log_writer is not None:
+            self.log_writer.configure(CONFIG.get('durability', {}))
+        # Retry policy for device reads
+        RETRY_POLICY = options['retry']
+        # Memory budget for arrays kept during a shot
+        SHOT_MEMORY = options['memory']
+        # Post shot analysis
+        if 'analysis' in CONFIG:
+            if ANALYSIS is None:
+                ANALYSIS = AnalysisPipeline(CONFIG['analysis'])
+            else:
+                ANALYSIS.configure(CONFIG['analysis'])
+        elif ANALYSIS is not None:
+            ANALYSIS.configure({})
+
+    def recover_state(self):
+        # Shot counter from the journal is newer than the one in config file.
+        # The log line is written before the journal record, so the last log lines
+        # of the journal day and of today are checked as well.
+        last = self.log_writer.recover()
+        days = [datetime.datetime.today()]
+        if last is not None:
+            try:
+                days.append(datetime.datetime.strptime(last[1], '%Y-%m-%d %H:%M:%S'))
+            except ValueError:
+                pass
+        candidates = [last]
+        if getattr(self, 'outRootDir', None) is None:
+            days = []
+        for day in days:
+            folder = os.path.join(self.outRootDir, day.strftime('%Y'), day.strftime('%Y-%m'), day.strftime('%Y-%m-%d'))
+            self.remove_stale_lock(folder)
+            candidates.append(last_log_shot(os.path.join(folder, day.strftime('%Y-%m-%d.log'))))
+        candidates = [c for c in candidates if c is not None]
+        if len(candidates) <= 0:
+            return
+        best = max(candidates, key=lambda c: c[0])
+        if best[0] > self.shot:
+            LOGGER.info('Shot counter restored from journal and log: %d -> %d' % (self.shot, best[0]))
+            self.shot = best[0]
+            CONFIG['shot_time'] = best[1]
+            # Journal is kept if the recovered counter can not be saved
+            if not self.write_config(self.config_file_name):
+                return
+        if last is not None:
+            self.log_writer.reset_journal()
+
+    def create_device(self, unit):
+        try:
+            if 'type' in unit:
+                item = build_device(unit)
+                LOGGER.info("%s %s has been added" % (unit['type'], str(item)))
+                return item
+            # Legacy python string entries.
+            # 'exec' and 'eval' share one namespace so that 'exec' can import plugins
+            ns = {}
+            if 'exec' in unit:
+                exec(unit["exec"], globals(), ns)
+            if 'eval' in unit:
+                item = eval(unit["eval"], globals(), ns)
+                LOGGER.info("%s has been added" % str(unit["eval"]))
+                return item
+            else:
+                LOGGER.debug("No 'eval' option for device %s" % unit)
+        except:
+            LOGGER.log(logging.WARNING, "Error in device processing %s" % str(unit))
+            print_exception_info()
+        return None
+
+    def device_keys_for(self, items):
+        # Key is the canonical json of the entry plus its occurrence number,
+        # so identical entries are distinguished but keep their identity between reloads
+        seen = {}
+        result = []
+        for unit in items:
+            s = json.dumps(unit, sort_keys=True)
+            seen[s] = seen.get(s, 0) + 1
+            result.append(((s, seen[s]), unit))
+        return result
+
+    def get_config_mtime(self):
+        try:
+            return os.path.getmtime(self.config_file_name)
+        except:
+            return None
+
+    def check_config(self):
+        # Called between shots: start background reload if config file has been changed
+        if self.reload_thread is not None:
+            if not self.reload_thread.is_alive():
+                self.reload_thread = None
+                self.apply_reload()
+            return
+        mtime = self.get_config_mtime()
+        if mtime is None or mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        try:
+            with open(self.config_file_name, 'r') as configfile:
+                new_config = json.loads(configfile.read())
+        except:
+            LOGGER.log(logging.WARNING, "Changed configuration in %s can not be read" % self.config_file_name)
+            print_exception_info()
+            return
+        LOGGER.info('Configuration change detected in %s' % self.config_file_name)
+        self.reload_thread = threading.Thread(target=self.prepare_reload, args=(new_config,), daemon=True)
+        self.reload_thread.start()
+
+    def prepare_reload(self, new_config):
+        # Runs in background: check options, construct and activate only new or changed entries.
+        # Any error keeps the running configuration untouched.
+        errors = validate_config(new_config)
+        options = None
+        if len(errors) <= 0:
+            try:
+                options = build_config_options(new_config)
+            except:
+                errors.append(str(sys.exc_info()[1]))
+                print_exception_info()
+        if len(errors) > 0:
+            for e in errors:
+                LOGGER.log(logging.ERROR, "Configuration error: %s" % e)
+            LOGGER.log(logging.ERROR, "Changed configuration in %s rejected, old configuration is kept" %
+                       self.config_file_name)
+            return
+        keys = self.device_keys_for(new_config.get('devices', []))
+        created = {}
+        for key, unit in keys:
+            if key in self.device_keys:
+                continue
+            item = self.create_device(unit)
+            if item is None:
+                continue
+            try:
+                item.activate()
+            except:
+                LOGGER.log(logging.WARNING, "Activation error for %s" % str(item))
+                print_exception_info()
+            created[key] = item
+        self.reload_result = (new_config, [key for key, unit in keys], created, options)
+
+    def apply_reload(self):
+        global CONFIG
+        global DEVICE_LIST
+        if self.reload_result is None:
+            return
+        new_config, keys, created, options = self.reload_result
+        self.reload_result = None
+        new_keys = {}
+        new_list = []
+        for key in keys:
+            if key in self.device_keys:
+                item = self.device_keys[key]
+            elif key in created:
+                item = created[key]
+            else:
+                continue
+            new_keys[key] = item
+            new_list.append(item)
+        # Tear down removed entries
+        for key in self.device_keys:
+            if key not in new_keys:
+                self.deactivate_device(self.device_keys[key])
+        added = len(created)
+        removed = len([key for key in self.device_keys if key not in new_keys])
+        # Shot counter is owned by the running dumper
+        for k in ('shot', 'shot_time'):
+            if k in CONFIG:
+                new_config[k] = CONFIG[k]
+        CONFIG = new_config
+        self.apply_config_options(options)
+        self.device_keys = new_keys
+        DEVICE_LIST = new_list
+        LOGGER.info('Configuration reloaded: %d devices added, %d removed, %d kept' %
+                    (added, removed, len(new_list) - added))
+
+    def deactivate_device(self, item):
+        try:
+            if hasattr(item, 'deactivate'):
+                item.deactivate()
+            item.active = False
+            LOGGER.info("%s has been removed" % str(item))
+        except:
+            print_exception_info()
+
     def write_config(self, file_name=CONFIG_FILE_NAME):
         global CONFIG
         try:
             CONFIG['shot'] = self.shot
-            with open(file_name, 'w') as configfile:
+            # Replace config file atomically, shot counter must never be lost
+            with open(file_name + '.tmp', 'w') as configfile:
                 configfile.write(json.dumps(CONFIG, indent=4))
+            os.replace(file_name + '.tmp', file_name)
+            # Own write must not trigger configuration reload
+            if file_name == self.config_file_name:
+                self.config_mtime = self.get_config_mtime()
             LOGGER.info('Configuration saved to %s' % file_name)
+            return True
         except:
             LOGGER.info('Configuration save error to %s' % file_name)
             print_exception_info()
@@ -844,44 +1464,43 @@ class ShotDumper:
 
     def process(self):
         global DEVICE_LIST
+        global DEADLINE
 
         self.logFile = None
         self.zipFile = None
+        self.start_metrics()
 
-        # Activate items in devices_list
-        count = 0   # Active item count
-        n = 0
-        for item in DEVICE_LIST:
-            try:
-                if item.activate():
-                    count += 1
-            except:
-                DEVICE_LIST.remove(item)
-                LOGGER.log(logging.ERROR, "Device %d removed from list due to activation error" % n)
-                print_exception_info()
-            n += 1
-        if count <= 0:
-            LOGGER.log(logging.CRITICAL, "No active devices")
+        if len(DEVICE_LIST) <= 0:
+            LOGGER.log(logging.CRITICAL, "No devices")
             return
+        # Activate items in devices_list concurrently
+        if self.activate_devices() <= 0:
+            LOGGER.log(logging.WARNING, "No active devices, waiting for background activation")
         # main loop
         print("%s Waiting for next shot ..." % self.time_stamp())
         while True:
             try:
                 new_shot = False
+                self.poll_activations()
                 for item in DEVICE_LIST:
+                    # reactivate inactive items in background
+                    if not item.active:
+                        self.retry_activation(item)
+                        continue
                     try:
-                        # reactivate all items
-                        item.activate()
                         # check for new shot
                         if item.new_shot():
                             new_shot = True
                             #break
                     except:
-                        DEVICE_LIST.remove(item)
-                        LOGGER.log(logging.ERROR, "Device %d removed from list due to activation error" % n)
+                        # Device is kept in the list and reconnected in background
+                        item.active = False
+                        LOGGER.log(logging.ERROR, "Device %s error, will be reactivated" % item.get_name())
                         print_exception_info()
 
                 if new_shot:
+                    shot_start = time.time()
+                    METRICS.trigger()
                     dts = self.date_time_stamp()
                     self.shot += 1
                     CONFIG['shot'] = self.shot
@@ -901,27 +1520,156 @@ class ShotDumper:
                     self.logFile.write('; Shot=%d' % self.shot)
                     # Open zip file
                     self.zipFile = self.open_zip_file(self.outFolder)
+                    SHOT_SIGNALS.clear()
+                    SHOT_VALUES.clear()
+                    SHOT_MEMORY.reset()
+                    del MISSING_SIGNALS[:]
+                    shot_deadline = ShotDeadline(CONFIG.get('shot_deadline'))
+                    n = len(DEVICE_LIST)
                     for item in DEVICE_LIST:
+                        METRICS.set('writer_queue', n)
+                        n -= 1
+                        if shot_deadline.expired():
+                            LOGGER.log(logging.WARNING, "Shot deadline exceeded, %s skipped" % item.get_name())
+                            MISSING_SIGNALS.append(item.get_name())
+                            continue
+                        if not item.active:
+                            LOGGER.log(logging.WARNING, "Device %s is not active, skipped" % item.get_name())
+                            MISSING_SIGNALS.append(item.get_name())
+                            continue
+                        budget = getattr(item, 'budget', None)
+                        if budget is None:
+                            budget = CONFIG.get('device_budget')
+                        DEADLINE = shot_deadline.budget(budget)
                         print("Saving from %s"%item.get_name())
                         try:
                             item.save(self.logFile, self.zipFile)
                         except:
+                            METRICS.inc('save_errors')
+                            MISSING_SIGNALS.append(item.get_name())
                             LOGGER.log(logging.WARNING, "Exception saving data from %s" % str(item))
                             print_exception_info()
+                        SHOT_MEMORY.sample()
+                    DEADLINE = ShotDeadline()
+                    METRICS.set('writer_queue', 0)
+                    if len(MISSING_SIGNALS) > 0:
+                        # Partial shot marker
+                        METRICS.inc('partial_shots')
+                        self.logFile.write('; MISSING=%s' % ','.join(MISSING_SIGNALS))
+                        self.zipFile.writestr("missing.txt", '\r\n'.join(MISSING_SIGNALS))
                     self.zipFile.close()
                     zfn = os.path.basename(self.zipFile.filename)
                     self.logFile.write('; File=%s' % zfn)
                     self.logFile.write('\n')
+                    # Whole line is written at once together with journal record
+                    log_bytes = self.log_writer.commit(self.logFileName, self.logFile.getvalue(), self.shot, dts)
                     self.logFile.close()
+                    self.save_summary(shot_start)
                     self.unlock_dir()
-                    self.write_config()
+                    if self.log_writer.journal_records >= JOURNAL_LIMIT and self.write_config(self.config_file_name):
+                        self.log_writer.reset_journal()
+                    if ANALYSIS is not None and len(ANALYSIS.tasks) > 0:
+                        ANALYSIS.submit(self.shot, dts, self.outFolder, self.zipFile.filename,
+                                        self.logFileName, dict(SHOT_SIGNALS))
+                    else:
+                        discard(SHOT_SIGNALS)
+                    SHOT_SIGNALS.clear()
+                    self.report_memory(SHOT_MEMORY.rss)
+                    METRICS.inc('shots_dumped')
+                    METRICS.inc('bytes_written', log_bytes + os.path.getsize(self.zipFile.filename))
+                    METRICS.set('last_shot', self.shot)
+                    METRICS.observe_latency(time.time() - shot_start)
                     print("%s Waiting for next shot ..." % self.time_stamp())
+                else:
+                    self.check_config()
+                self.collect_analysis()
+                self.update_status()
             except:
                 LOGGER.log(logging.CRITICAL, "Unexpected exception")
                 print_exception_info()
+                self.close()
                 return
             time.sleep(CONFIG['sleep'])
 
+    def collect_analysis(self):
+        # Write finished analysis results to daily log and shot zip file
+        if ANALYSIS is None:
+            return
+        results = self.analysis_postponed + ANALYSIS.ready()
+        self.analysis_postponed = []
+        for result in results:
+            shot, dts, folder, zip_file_name, log_file_name, values = result
+            if len(values) <= 0:
+                continue
+            if not os.path.isdir(folder):
+                LOGGER.log(logging.WARNING, "Folder %s is gone, analysis results for shot %d lost" % (folder, shot))
+                continue
+            lock_file = self.try_lock_dir(folder)
+            if lock_file is None:
+                # Folder is busy (compactor or retention worker), try again later
+                self.analysis_postponed.append(result)
+                continue
+            try:
+                self.log_writer.write_line(log_file_name, ANALYSIS.format_line(shot, dts, values))
+                # A compacted and removed shot zip must not be recreated with results only
+                if os.path.exists(zip_file_name):
+                    with zipfile.ZipFile(zip_file_name, 'a', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                        zip_file.writestr(RESULTS_ENTRY % shot, ANALYSIS.format_buf(shot, values))
+                else:
+                    LOGGER.log(logging.WARNING, "%s no longer exists, analysis results for shot %d are in log only" %
+                               (zip_file_name, shot))
+                if CONFIG.get('summary', True):
+                    self.get_summary(folder).update(shot, {k: v for k, v in values if v is not None})
+                LOGGER.log(logging.DEBUG, "Analysis results for shot %d saved" % shot)
+            except:
+                LOGGER.log(logging.WARNING, "Analysis results save error for shot %d" % shot)
+                print_exception_info()
+            finally:
+                lock_file.close()
+                os.remove(lock_file.name)
+
+    def get_summary(self, folder):
+        # One table object per day folder, so its schema is always current
+        if self.summary is None or self.summary.folder != os.path.join(folder, SUMMARY_FOLDER):
+            self.summary = SummaryTable(folder)
+        return self.summary
+
+    def save_summary(self, shot_time):
+        # Columnar copy of the values of the daily log line
+        if not CONFIG.get('summary', True):
+            return
+        try:
+            self.get_summary(self.outFolder).append(self.shot, shot_time, SHOT_VALUES)
+        except:
+            self.summary = None
+            LOGGER.log(logging.WARNING, "Summary table write error")
+            print_exception_info()
+
+    def report_memory(self, shot_rss):
+        mb = 1024.0 * 1024.0
+        if shot_rss is not None:
+            METRICS.set('shot_peak_rss_bytes', shot_rss)
+        METRICS.set('shot_kept_bytes', SHOT_MEMORY.peak)
+        METRICS.inc('spilled_bytes', SHOT_MEMORY.spilled)
+        LOGGER.log(logging.INFO, "Shot %d memory: peak RSS %s MB, kept %.1f MB, spilled %.1f MB" %
+                   (self.shot, '%.1f' % (shot_rss / mb) if shot_rss is not None else 'n/a',
+                    SHOT_MEMORY.peak / mb, SHOT_MEMORY.spilled / mb))
+
+    def start_metrics(self):
+        METRICS.add_source('analysis_queue', lambda: ANALYSIS.queue_length() if ANALYSIS is not None else 0)
+        METRICS.add_source('devices', lambda: len(DEVICE_LIST))
+        METRICS.add_source('active_devices', lambda: len([d for d in DEVICE_LIST if d.active]))
+        METRICS.add_source('inactive_devices', lambda: len([d for d in DEVICE_LIST if not d.active]))
+        METRICS.set('writer_queue', 0)
+        opt = CONFIG.get('metrics', {})
+        if 'port' in opt:
+            METRICS.start_server(opt['port'], opt.get('host', '127.0.0.1'))
+
+    def update_status(self):
+        opt = CONFIG.get('metrics', {})
+        if 'file' in opt:
+            METRICS.write_status(opt['file'], opt.get('interval', 5.0))
+
     def make_log_folder(self):
         of = os.path.join(self.outRootDir, self.get_log_folder())
         try:
@@ -944,13 +1692,114 @@ class ShotDumper:
 
     def lock_dir(self, folder):
         self.lockFile = open(os.path.join(folder, "lock.lock"), 'w+')
+        self.lockFile.write(PROG_NAME_SHORT)
+        self.lockFile.flush()
         self.locked = True
         LOGGER.log(logging.DEBUG, "Directory %s locked", folder)
 
+    def try_lock_dir(self, folder):
+        # Lock folder only if nobody else holds lock.lock
+        try:
+            lock_file = open(os.path.join(folder, "lock.lock"), 'x')
+        except FileExistsError:
+            return None
+        lock_file.write(PROG_NAME_SHORT)
+        lock_file.flush()
+        return lock_file
+
+    def remove_stale_lock(self, folder):
+        # lock.lock left by a crashed dumper blocks compactor and retention worker forever.
+        # Locks of other tools carry their own name and are left alone.
+        fn = os.path.join(folder, "lock.lock")
+        if self.lockFile is not None and os.path.abspath(self.lockFile.name) == os.path.abspath(fn):
+            return
+        try:
+            with open(fn, 'r') as lock_file:
+                owner = lock_file.read().strip()
+        except:
+            return
+        if owner != '' and owner != PROG_NAME_SHORT:
+            return
+        try:
+            os.remove(fn)
+            LOGGER.log(logging.WARNING, "Stale lock %s removed" % fn)
+        except:
+            LOGGER.log(logging.WARNING, "Can not remove stale lock %s" % fn)
+
     def open_log_file(self, folder=''):
         self.logFileName = os.path.join(folder, self.get_log_file_name())
-        logf = open(self.logFileName, 'a')
-        return logf
+        # Shot line is collected in memory and written by log_writer in one piece
+        return io.StringIO()
+
+    def activate_devices(self):
+        # Activate all devices concurrently, wait not longer than startup_deadline,
+        # then print readiness summary. Returns number of active devices.
+        deadline = CONFIG.get('startup_deadline', 10.0)
+        workers = CONFIG.get('startup_workers', 16)
+        self.activation_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                                     thread_name_prefix='activate')
+        t0 = time.time()
+        for item in DEVICE_LIST:
+            self.start_activation(item)
+        futures = [f for f, t in self.activations.values()]
+        concurrent.futures.wait(futures, timeout=deadline)
+        results = self.poll_activations(False)
+        count = 0
+        for item in DEVICE_LIST:
+            if item.active:
+                count += 1
+            if item in results:
+                ok, dt = results[item]
+                if ok:
+                    LOGGER.info("%s ready, connected in %.3f s" % (item.get_name(), dt))
+                else:
+                    LOGGER.warning("%s failed after %.3f s, retrying in background" % (item.get_name(), dt))
+            else:
+                LOGGER.warning("%s not ready after %.1f s startup deadline, still connecting" %
+                               (item.get_name(), deadline))
+        print("%s %d of %d devices ready in %.1f s" % (self.time_stamp(), count, len(DEVICE_LIST), time.time() - t0))
+        return count
+
+    def start_activation(self, item):
+        if item in self.activations:
+            return
+        self.activations[item] = (self.activation_pool.submit(activate_item, item), time.time())
+
+    def retry_activation(self, item):
+        if item in self.activations or time.time() < self.retry_time.get(item, 0.0):
+            return
+        self.start_activation(item)
+
+    def poll_activations(self, report=True):
+        # Collect finished activations as {item: (success, connect time)}
+        results = {}
+        for item, (future, t) in list(self.activations.items()):
+            if not future.done():
+                continue
+            del self.activations[item]
+            results[item] = future.result()
+            ok, dt = results[item]
+            if ok:
+                self.retry_time.pop(item, None)
+                if report:
+                    LOGGER.info("%s ready, connected in %.3f s" % (item.get_name(), dt))
+            else:
+                self.retry_time[item] = time.time() + CONFIG.get('activation_retry', 10.0)
+        return results
+
+    def close(self):
+        # Flush log and journal, save shot counter
+        if ANALYSIS is not None:
+            ANALYSIS.shutdown()
+        discard(SHOT_SIGNALS)
+        SHOT_SIGNALS.clear()
+        if self.activation_pool is not None:
+            self.activation_pool.shutdown(wait=False, cancel_futures=True)
+            self.activation_pool = None
+        if self.log_writer is not None:
+            self.log_writer.close()
+            if self.write_config(self.config_file_name):
+                self.log_writer.reset_journal()
 
     def get_log_file_name(self):
         logfn = datetime.datetime.today().strftime('%Y-%m-%d.log')
@@ -977,6 +1826,16 @@ class ShotDumper:
 
 
 if __name__ == '__main__':
+    if '--validate' in sys.argv:
+        # Offline check of configuration: ShotDumper.py --validate [config file]
+        args = [a for a in sys.argv[1:] if a != '--validate']
+        file_name = args[0] if args else CONFIG_FILE_NAME
+        with open(file_name, 'r') as configfile:
+            errors = validate_config(json.loads(configfile.read()))
+        for e in errors:
+            print(e)
+        print("%s: %d errors" % (file_name, len(errors)))
+        sys.exit(1 if errors else 0)
     sd = ShotDumper()
     try:
         sd.read_config()
@@ -984,3 +1843,4 @@ if __name__ == '__main__':
     except:
         LOGGER.log(logging.CRITICAL, "Exception in %s", PROG_NAME_SHORT)
         print_exception_info()
+        sd.close()
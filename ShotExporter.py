@@ -0,0 +1,184 @@
+import os
+import os.path
+import re
+import sys
+import json
+import logging
+import datetime
+import argparse
+import zipfile
+import concurrent.futures
+
+import numpy
+
+from ArchiveCompactor import config_logger, day_folders, folder_date, read_shot_numbers, \
+    shot_zip_files, container_name, base_key, ShotContainer
+
+# Configure logging
+LOGGER = config_logger(__name__)
+
+PROG_NAME = "Shot Archive Exporter"
+PROG_NAME_SHORT = "ShotExporter"
+PROG_VERSION = "1.0"
+
+INDEX_FILE_NAME = "export.json"
+ZIP_TIME_RE = re.compile(r'(\d{4}-\d{2}-\d{2}_\d{6})')
+
+
+def print_exception_info(level=logging.DEBUG):
+    LOGGER.log(level, "Exception ", exc_info=True)
+
+
+def parse_text(data):
+    # Vectorized parser of '%f; %f' or '%f' lines written by ShotDumper
+    if isinstance(data, bytes):
+        data = data.decode(errors='replace')
+    # Text starts with '\r\n' when the signal is shorter than save_avg
+    data = data.lstrip()
+    first = data[:data.find('\n')] if '\n' in data else data
+    columns = first.count(';') + 1
+    if data.strip() == '':
+        return numpy.zeros((0, columns))
+    a = numpy.fromstring(data.replace(';', ' ').replace(',', '.'), dtype=numpy.float64, sep=' ')
+    return a[:len(a) // columns * columns].reshape(-1, columns)
+
+
+def shot_time(name):
+    m = ZIP_TIME_RE.search(name)
+    if m is None:
+        return numpy.nan
+    return datetime.datetime.strptime(m.group(1), '%Y-%m-%d_%H%M%S').timestamp()
+
+
+def find_shots(root, first_date=None, last_date=None, first_shot=None, last_shot=None):
+    # List of (shot, time, file name, key in container or None) in time order
+    jobs = []
+    for folder in day_folders(root):
+        d = folder_date(folder)
+        if d is None or (first_date is not None and d < first_date) or (last_date is not None and d > last_date):
+            continue
+        numbers = read_shot_numbers(folder)
+        files = shot_zip_files(folder)
+        for fn in files:
+            jobs.append((numbers.get(fn, -1), shot_time(fn), os.path.join(folder, fn), None))
+        # Compacted shots, skipping those whose zip files are still present
+        cn = container_name(folder)
+        if os.path.exists(cn):
+            with ShotContainer(cn) as c:
+                for key in c.shots():
+                    if base_key(key) + '.zip' in files:
+                        continue
+                    jobs.append((c.index['shots'][key].get('shot') or -1, shot_time(key), cn, key))
+    if first_shot is not None:
+        jobs = [j for j in jobs if j[0] >= first_shot]
+    if last_shot is not None:
+        jobs = [j for j in jobs if j[0] <= last_shot]
+    jobs.sort(key=lambda j: (j[1], j[0]))
+    return jobs
+
+
+def read_shot(job, signals):
+    # Executed in a worker process, returns {signal: (x, y)} for found signals
+    shot, t, file_name, key = job
+    result = {}
+    try:
+        with zipfile.ZipFile(file_name, 'r') as zip_file:
+            for signal in signals:
+                entry = signal + '.txt'
+                if key is not None:
+                    entry = key + '/' + entry
+                try:
+                    a = parse_text(zip_file.read(entry))
+                except KeyError:
+                    continue
+                if a.shape[1] >= 2:
+                    result[signal] = (a[:, 0], a[:, 1])
+                else:
+                    result[signal] = (numpy.arange(len(a), dtype=numpy.float64), a[:, 0])
+    except:
+        LOGGER.log(logging.WARNING, "Error reading %s" % file_name)
+    return result
+
+
+def safe_name(signal):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', signal)
+
+
+def export(jobs, signals, out_dir, workers=None):
+    # Output: per signal raw float64 columns shot, x, y (one row per point),
+    # loadable with load_export() or numpy.memmap
+    os.makedirs(out_dir, exist_ok=True)
+    files = {}
+    index = {'signals': {}, 'shots': [], 'times': []}
+    for signal in signals:
+        name = safe_name(signal)
+        index['signals'][signal] = {'rows': 0, 'columns': {}}
+        for col in ('shot', 'x', 'y'):
+            fn = '%s.%s.f8' % (name, col)
+            files[(signal, col)] = open(os.path.join(out_dir, fn), 'wb')
+            index['signals'][signal]['columns'][col] = fn
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(read_shot, jobs, [signals] * len(jobs), chunksize=4)
+            for job, result in zip(jobs, results):
+                index['shots'].append(job[0])
+                index['times'].append(job[1])
+                for signal in result:
+                    x, y = result[signal]
+                    numpy.full(len(y), job[0], dtype=numpy.float64).tofile(files[(signal, 'shot')])
+                    x.astype(numpy.float64).tofile(files[(signal, 'x')])
+                    y.astype(numpy.float64).tofile(files[(signal, 'y')])
+                    index['signals'][signal]['rows'] += len(y)
+    finally:
+        for f in files.values():
+            f.close()
+    with open(os.path.join(out_dir, INDEX_FILE_NAME), 'w') as f:
+        f.write(json.dumps(index, indent=1))
+    return index
+
+
+def load_export(out_dir, mmap=True):
+    # {signal: {'shot': array, 'x': array, 'y': array}}
+    with open(os.path.join(out_dir, INDEX_FILE_NAME), 'r') as f:
+        index = json.loads(f.read())
+    result = {}
+    for signal, info in index['signals'].items():
+        result[signal] = {}
+        for col, fn in info['columns'].items():
+            path = os.path.join(out_dir, fn)
+            if mmap and info['rows'] > 0:
+                result[signal][col] = numpy.memmap(path, dtype=numpy.float64, mode='r', shape=(info['rows'],))
+            else:
+                result[signal][col] = numpy.fromfile(path, dtype=numpy.float64, count=info['rows'])
+    return result
+
+
+def parse_date(s):
+    if s is None:
+        return None
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PROG_NAME)
+    parser.add_argument('root', help='ShotDumper output directory (outDir)')
+    parser.add_argument('signals', nargs='+', help='signal names as zip members without .txt, e.g. ADC_0/chany1')
+    parser.add_argument('-o', '--out', default='export', help='output directory')
+    parser.add_argument('--from', dest='first_date', default=None, help='first date YYYY-MM-DD')
+    parser.add_argument('--to', dest='last_date', default=None, help='last date YYYY-MM-DD')
+    parser.add_argument('--first-shot', type=int, default=None)
+    parser.add_argument('--last-shot', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    LOGGER.setLevel(logging.INFO)
+    try:
+        shot_jobs = find_shots(args.root, parse_date(args.first_date), parse_date(args.last_date),
+                               args.first_shot, args.last_shot)
+        LOGGER.log(logging.INFO, "%d shots found" % len(shot_jobs))
+        idx = export(shot_jobs, args.signals, args.out, args.workers)
+        for sig in idx['signals']:
+            LOGGER.log(logging.INFO, "%s: %d points" % (sig, idx['signals'][sig]['rows']))
+    except:
+        LOGGER.log(logging.CRITICAL, "Exception in %s", PROG_NAME_SHORT)
+        print_exception_info(logging.ERROR)
+        sys.exit(1)
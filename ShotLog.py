@@ -0,0 +1,166 @@
+import os
+import re
+import time
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+SHOT_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}); Shot=(\d+)')
+# Size of the log tail searched for the last shot number
+TAIL_BYTES = 1 << 16
+
+# fsync policies
+DURABILITY_ALWAYS = 'always'
+DURABILITY_BATCH = 'batch'
+DURABILITY_NONE = 'none'
+
+
+class ShotLogWriter:
+    # Writes whole shot lines to daily log files with one write() each and
+    # keeps shot counter in an append only journal "shot;date time\n".
+    def __init__(self, journal_file_name, mode=DURABILITY_BATCH, batch_shots=10, batch_seconds=5.0):
+        self.journal_file_name = journal_file_name
+        self.mode = mode
+        self.batch_shots = batch_shots
+        self.batch_seconds = batch_seconds
+        self.log_file_name = None
+        self.log_fd = None
+        self.journal_fd = None
+        self.journal_records = 0
+        self.unsynced = 0
+        self.sync_time = time.time()
+
+    def configure(self, opt):
+        self.mode = opt.get('mode', self.mode)
+        self.batch_shots = opt.get('shots', self.batch_shots)
+        self.batch_seconds = opt.get('seconds', self.batch_seconds)
+
+    def open_log(self, file_name):
+        if file_name == self.log_file_name and self.log_fd is not None:
+            return self.log_fd
+        self.close_log()
+        repair_log(file_name)
+        self.log_fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.log_file_name = file_name
+        return self.log_fd
+
+    def close_log(self):
+        if self.log_fd is not None:
+            try:
+                os.fsync(self.log_fd)
+            except OSError:
+                pass
+            os.close(self.log_fd)
+        self.log_fd = None
+        self.log_file_name = None
+
+    def write_line(self, file_name, line):
+        if not line.endswith('\n'):
+            line += '\n'
+        os.write(self.open_log(file_name), line.encode())
+        return len(line)
+
+    def commit(self, file_name, line, shot, dts):
+        # Log line first, then journal record, so that a recorded shot number
+        # always has its line in the log
+        n = self.write_line(file_name, line)
+        if self.journal_fd is None:
+            self.journal_fd = os.open(self.journal_file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.journal_fd, ('%d;%s\n' % (shot, dts)).encode())
+        self.journal_records += 1
+        self.unsynced += 1
+        self.sync()
+        return n
+
+    def sync(self, force=False):
+        if self.unsynced <= 0:
+            return
+        if not force:
+            if self.mode == DURABILITY_NONE:
+                return
+            if self.mode == DURABILITY_BATCH and self.unsynced < self.batch_shots and \
+                    time.time() - self.sync_time < self.batch_seconds:
+                return
+        for fd in (self.log_fd, self.journal_fd):
+            if fd is not None:
+                os.fsync(fd)
+        self.unsynced = 0
+        self.sync_time = time.time()
+
+    def recover(self):
+        # Last complete journal record as (shot, date time) or None
+        try:
+            with open(self.journal_file_name, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        last = None
+        for line in data.split(b'\n')[:-1]:
+            try:
+                shot, dts = line.decode().split(';', 1)
+                last = (int(shot), dts)
+            except ValueError:
+                LOGGER.log(logging.WARNING, "Damaged journal record %s" % line)
+        return last
+
+    def reset_journal(self):
+        # Called after the shot counter has been saved to the config file
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            self.journal_fd = None
+        with open(self.journal_file_name, 'w'):
+            pass
+        self.journal_records = 0
+
+    def close(self):
+        self.sync(True)
+        self.close_log()
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            self.journal_fd = None
+
+
+def repair_log(file_name):
+    # Cut a partial last line left by a crash in the middle of a write
+    try:
+        with open(file_name, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size <= 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            pos = size - 1
+            block = 4096
+            while pos > 0:
+                start = max(0, pos - block)
+                f.seek(start)
+                k = f.read(pos - start).rfind(b'\n')
+                if k >= 0:
+                    pos = start + k + 1
+                    break
+                pos = start
+            f.truncate(pos)
+            LOGGER.log(logging.WARNING, "Partial line removed from %s" % file_name)
+    except FileNotFoundError:
+        pass
+
+
+def last_log_shot(file_name):
+    # Largest (shot, date time) in complete lines of the log tail, None if no shot lines.
+    # Analysis lines of older shots may follow the last shot line, so the maximum is taken.
+    try:
+        with open(file_name, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - TAIL_BYTES))
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    last = None
+    for line in data.split(b'\n')[:-1]:
+        m = SHOT_RE.match(line.decode(errors='replace'))
+        if m is not None and (last is None or int(m.group(2)) > last[0]):
+            last = (int(m.group(2)), m.group(1))
+    return last
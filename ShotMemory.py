@@ -0,0 +1,103 @@
+import os
+import logging
+import tempfile
+
+import numpy
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SpilledArray:
+    # Array moved to a temporary file, reopened as read only memory map on use
+    def __init__(self, file_name, dtype, shape):
+        self.file_name = file_name
+        self.dtype = dtype
+        self.shape = shape
+
+    def load(self):
+        if len(self.shape) <= 0 or self.shape[0] == 0:
+            return numpy.zeros(self.shape, dtype=self.dtype)
+        return numpy.memmap(self.file_name, dtype=self.dtype, mode='r', shape=self.shape)
+
+    def remove(self):
+        try:
+            os.remove(self.file_name)
+        except:
+            LOGGER.log(logging.DEBUG, "Can not remove %s" % self.file_name)
+
+
+class MemoryBudget:
+    # Accounts arrays kept in memory during one shot.
+    # Arrays which do not fit into the limit are spilled to disk.
+    def __init__(self, limit=None, spill_dir=None):
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.reset()
+
+    def reset(self):
+        self.used = 0
+        self.peak = 0
+        self.spilled = 0
+        self.rss = None
+        self.sample()
+
+    def sample(self):
+        # Largest resident set size seen during the shot, sampled while encode
+        # buffers of a device are alive, not only between devices
+        rss = current_rss()
+        if rss is not None and (self.rss is None or rss > self.rss):
+            self.rss = rss
+
+    def keep(self, value):
+        if value is None:
+            return None
+        a = numpy.asarray(value)
+        if self.limit is not None and self.used + a.nbytes > self.limit and a.nbytes > 0:
+            try:
+                return self.spill(a)
+            except:
+                LOGGER.log(logging.WARNING, "Array spill error, kept in memory")
+                LOGGER.log(logging.DEBUG, "Exception ", exc_info=True)
+        self.used += a.nbytes
+        self.peak = max(self.peak, self.used)
+        return a
+
+    def spill(self, a):
+        fd, file_name = tempfile.mkstemp(prefix='shot_', suffix='.dat', dir=self.spill_dir)
+        os.close(fd)
+        m = numpy.memmap(file_name, dtype=a.dtype, mode='w+', shape=a.shape)
+        m[...] = a
+        m.flush()
+        del m
+        self.spilled += a.nbytes
+        return SpilledArray(file_name, a.dtype.str, a.shape)
+
+
+def as_array(value):
+    if isinstance(value, SpilledArray):
+        return value.load()
+    return value
+
+
+def discard(signals):
+    # Remove temporary files of spilled signals
+    for pair in signals.values():
+        for v in pair:
+            if isinstance(v, SpilledArray):
+                v.remove()
+
+
+def current_rss():
+    # Resident set size of this process, bytes, None if unknown
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except:
+        return None
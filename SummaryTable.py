@@ -0,0 +1,146 @@
+import os
+import os.path
+import json
+import logging
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+SUMMARY_FOLDER = "summary"
+SCHEMA_FILE_NAME = "schema.json"
+# Columns present in every table
+SHOT_COLUMN = "Shot"
+TIME_COLUMN = "Time"
+
+
+class SummaryTable:
+    # Per day table of shot values: one binary file per column, one row per shot.
+    # Rows are appended, columns may appear at any time and are backfilled with NaN.
+    # schema.json is rewritten after column files, so a crash leaves at most
+    # an unreferenced tail which is cut on next open.
+    def __init__(self, folder):
+        self.folder = os.path.join(folder, SUMMARY_FOLDER)
+        self.schema_file_name = os.path.join(self.folder, SCHEMA_FILE_NAME)
+        self.rows = 0
+        self.columns = {}
+        if os.path.exists(self.schema_file_name):
+            with open(self.schema_file_name, 'r') as f:
+                schema = json.loads(f.read())
+            self.rows = schema['rows']
+            self.columns = schema['columns']
+            self.repair()
+        else:
+            os.makedirs(self.folder, exist_ok=True)
+            self.add_column(SHOT_COLUMN, '<i8')
+            self.add_column(TIME_COLUMN, '<f8')
+
+    def column_file(self, name):
+        return os.path.join(self.folder, self.columns[name]['file'])
+
+    def repair(self):
+        for name in self.columns:
+            size = self.rows * numpy.dtype(self.columns[name]['dtype']).itemsize
+            fn = self.column_file(name)
+            if not os.path.exists(fn):
+                LOGGER.log(logging.WARNING, "Summary column %s lost, filled with NaN" % name)
+                self.fill(fn, self.columns[name]['dtype'], self.rows)
+            elif os.path.getsize(fn) > size:
+                with open(fn, 'r+b') as f:
+                    f.truncate(size)
+
+    def fill(self, file_name, dtype, n):
+        a = numpy.full(n, numpy.nan if dtype[1] == 'f' else -1, dtype=dtype)
+        with open(file_name, 'ab') as f:
+            a.tofile(f)
+
+    def add_column(self, name, dtype='<f8'):
+        fn = 'c%04d%s' % (len(self.columns), dtype.replace('<', '.'))
+        self.columns[name] = {'file': fn, 'dtype': dtype}
+        open(os.path.join(self.folder, fn), 'wb').close()
+        self.fill(os.path.join(self.folder, fn), dtype, self.rows)
+
+    def write_schema(self):
+        tmp_name = self.schema_file_name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            f.write(json.dumps({'rows': self.rows, 'columns': self.columns}, indent=1))
+        os.replace(tmp_name, self.schema_file_name)
+
+    def append(self, shot, shot_time, values):
+        for name in values:
+            if name not in self.columns:
+                self.add_column(name)
+        for name in self.columns:
+            dtype = self.columns[name]['dtype']
+            if name == SHOT_COLUMN:
+                v = shot
+            elif name == TIME_COLUMN:
+                v = shot_time
+            else:
+                v = values.get(name, numpy.nan)
+            with open(self.column_file(name), 'ab') as f:
+                numpy.array([v], dtype=dtype).tofile(f)
+        self.rows += 1
+        self.write_schema()
+
+    def update(self, shot, values):
+        # Set values of an already written row, used for late results
+        shots = numpy.fromfile(self.column_file(SHOT_COLUMN), dtype=self.columns[SHOT_COLUMN]['dtype'],
+                               count=self.rows)
+        index = numpy.nonzero(shots == shot)[0]
+        if len(index) <= 0:
+            return False
+        row = int(index[-1])
+        for name in values:
+            if name not in self.columns:
+                self.add_column(name)
+            dtype = numpy.dtype(self.columns[name]['dtype'])
+            with open(self.column_file(name), 'r+b') as f:
+                f.seek(row * dtype.itemsize)
+                numpy.array([values[name]], dtype=dtype).tofile(f)
+        self.write_schema()
+        return True
+
+
+def load_summary(folder, columns=None, mmap=False):
+    # Read one day table as {column name: array}, one vectorized read per column
+    summary_folder = os.path.join(folder, SUMMARY_FOLDER)
+    with open(os.path.join(summary_folder, SCHEMA_FILE_NAME), 'r') as f:
+        schema = json.loads(f.read())
+    rows = schema['rows']
+    result = {}
+    for name, col in schema['columns'].items():
+        if columns is not None and name not in columns and name not in (SHOT_COLUMN, TIME_COLUMN):
+            continue
+        fn = os.path.join(summary_folder, col['file'])
+        if mmap and rows > 0:
+            result[name] = numpy.memmap(fn, dtype=col['dtype'], mode='r', shape=(rows,))
+        else:
+            result[name] = numpy.fromfile(fn, dtype=col['dtype'], count=rows)
+    return result
+
+
+def load_summaries(folders, columns=None):
+    # Concatenate several days, columns missing in some days are NaN there
+    tables = []
+    for folder in folders:
+        try:
+            tables.append(load_summary(folder, columns))
+        except FileNotFoundError:
+            continue
+    names = []
+    for t in tables:
+        for name in t:
+            if name not in names:
+                names.append(name)
+    result = {}
+    for name in names:
+        parts = []
+        for t in tables:
+            n = len(t[SHOT_COLUMN])
+            if name in t:
+                parts.append(t[name])
+            else:
+                parts.append(numpy.full(n, numpy.nan))
+        result[name] = numpy.concatenate(parts) if parts else numpy.zeros(0)
+    return result
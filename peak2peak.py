@@ -1,12 +1,20 @@
 from ShotDumper import TangoAttribute
 import time
+import numpy
+import tango
 
 class TangoAttributepeak2peak(TangoAttribute):
     def read_attribute(self):
-        self.attr = self.devProxy.read_attribute(self.name)
+        self.attr = self.devProxy.read_attribute(self.name, extract_as=tango.ExtractAs.Numpy)
         self.time = time.time()
-        v1 = [c.value for c in self.devProxy.attribute_history(self.name, 100)]
-        v2 = max(v1)
-        v3 = min(v1)
+        history = self.devProxy.attribute_history(self.name, 100, extract_as=tango.ExtractAs.Numpy)
+        # argmax/argmin over a float copy, the stored value keeps the attribute type
+        try:
+            v1 = numpy.fromiter((c.value for c in history), dtype=numpy.float64, count=len(history))
+            v2 = history[int(numpy.argmax(v1))].value
+            v3 = history[int(numpy.argmin(v1))].value
+        except (TypeError, ValueError):
+            v2 = max(c.value for c in history)
+            v3 = min(c.value for c in history)
         self.attr.value = v2 - v3
 